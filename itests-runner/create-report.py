@@ -4,14 +4,68 @@ import argparse
 import datetime
 import glob
 import json
+import multiprocessing
 import re
 import os
+import shutil
+import sqlite3
+import subprocess
+import uuid
 from xml.etree import ElementTree
 
 import colorama
 import jinja2
 
 
+# See run-tests.py write_time_budget_report.
+TIME_BUDGET_TEST_CLASS = 'TimeBudget'
+# Test outputs larger than this (in characters) are written to files of their
+# own under OUTPUTS_DIR, and linked from the report rather than shown in it.
+MAX_INLINE_OUTPUT_SIZE = 64 * 1024
+OUTPUTS_DIR = 'report-outputs'
+# The details (error and outputs) of the test cases of each report file are
+# written to a script file under REPORT_DETAILS_DIR while it is parsed, and
+# loaded by report.html on demand.
+REPORT_DETAILS_DIR = 'report-details'
+# Parsed reports are cached in the work directory, keyed by file name, size
+# and modification time.
+REPORT_CACHE_FILE = 'report-cache.json'
+REPORT_CACHE_VERSION = 2
+# The junit error type of the test cases of a run killed on timeout (see
+# run-tests.py `HangWatchdog`).
+TIMEOUT_ERROR_TYPE = 'timeout'
+# The id of the run the work directory's reports belong to, so recording them
+# again in the warehouse replaces their records.
+RUN_ID_FILE = 'run-id'
+WAREHOUSE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    timestamp TEXT
+);
+CREATE TABLE IF NOT EXISTS run_repositories (
+    run TEXT,
+    repository TEXT,
+    branch TEXT,
+    revision TEXT,
+    PRIMARY KEY (run, repository)
+);
+CREATE TABLE IF NOT EXISTS results (
+    run TEXT,
+    server INTEGER,
+    suite TEXT,
+    module TEXT,
+    class TEXT,
+    test TEXT,
+    duration REAL,
+    outcome TEXT,
+    timed_out INTEGER DEFAULT 0,
+    PRIMARY KEY (run, server, module, class, test)
+);
+CREATE INDEX IF NOT EXISTS results_test ON results (module, class, test);
+CREATE INDEX IF NOT EXISTS results_run ON results (run);
+"""
+
+
 class TestSuite(object):
 
     def __init__(self):
@@ -37,44 +91,251 @@ class TestCase(object):
         self.name = None
         self.classname = None
         self.passed = None
-        self.error = None
-        self.stdout = None
-        self.stderr = None
+        self.outcome = None
         self.time = None
-
-
-def build_test_case(testcase):
+        # Whether the test case's run was killed on timeout, so its time is
+        # the timeout.
+        self.timed_out = False
+        # The details file of the test case and its index in it.
+        self.details_file = None
+        self.details_index = None
+
+
+def spill_output(text, work_dir, output_file):
+    """Write a test output to `output_file` (relative to the work directory,
+    under OUTPUTS_DIR), and return it.
+    """
+    output_dir = os.path.dirname(os.path.join(work_dir, output_file))
+    if not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    with open(os.path.join(work_dir, output_file), 'wb') as f:
+        f.write(text.encode('utf-8'))
+    return output_file
+
+
+def get_report_name(xml_file):
+    return os.path.splitext(os.path.basename(xml_file))[0]
+
+
+def build_test_case(testcase, work_dir, report_name, index):
+    """Build a TestCase of a junit `testcase` element (the `index` test case
+    of its report), and return it along with its details (error and outputs).
+
+    Outputs larger than MAX_INLINE_OUTPUT_SIZE are written to files under
+    OUTPUTS_DIR/`report_name` (see `spill_output`), and the details refer to
+    them.
+    """
     case = TestCase()
     case.name = testcase.attrib['name']
     case.classname = testcase.attrib['classname']
     case.time = float(testcase.attrib['time'])
     case.passed = True
+    case.outcome = 'passed'
+    details = {'error': None, 'stdout': None, 'stderr': None, 'stdout_file': None, 'stderr_file': None}
     for elem in testcase:
         if elem.tag == 'error':
             case.passed = False
-            case.error = elem.text
+            case.outcome = 'error'
+            case.timed_out = elem.attrib.get('type') == TIMEOUT_ERROR_TYPE
+            details['error'] = elem.text
         if elem.tag == 'failure':
             case.passed = False
-        if elem.tag == 'system-out':
-            case.stdout = elem.text
-        if elem.tag == 'system-err':
-            case.stderr = elem.text
-    return case
+            case.outcome = 'failure'
+        if elem.tag == 'skipped':
+            case.outcome = 'skipped'
+        if elem.tag in ('system-out', 'system-err'):
+            output = 'stdout' if elem.tag == 'system-out' else 'stderr'
+            if elem.text and len(elem.text) > MAX_INLINE_OUTPUT_SIZE:
+                details[output + '_file'] = spill_output(
+                    elem.text, work_dir, '{0}/{1}/{2}-{3}.txt'.format(OUTPUTS_DIR, report_name, index, output))
+            else:
+                details[output] = elem.text
+    return case, details
 
 
 def build_test_suite(testsuite):
+    """Build a TestSuite of the attributes of a junit `testsuite` element
+    (its test cases are added by `iter_test_suites`).
+    """
     suite = TestSuite()
     suite.name = testsuite.attrib['name']
     suite.tests = int(testsuite.attrib['tests'])
     suite.errors = int(testsuite.attrib['errors'])
     suite.failures = int(testsuite.attrib['failures'])
     suite.skipped = int(testsuite.attrib['skip'])
-    for testcase in testsuite:
-        suite.testcases.append(build_test_case(testcase))
-    suite.time = sum([x.time for x in suite.testcases])
     return suite
 
 
+def remove_report_details(xml_file, work_dir):
+    """Remove the details file and the output files of a report file."""
+    report_name = get_report_name(xml_file)
+    details_file = os.path.join(work_dir, REPORT_DETAILS_DIR, '{0}.js'.format(report_name))
+    if os.path.exists(details_file):
+        os.remove(details_file)
+    outputs_dir = os.path.join(work_dir, OUTPUTS_DIR, report_name)
+    if os.path.exists(outputs_dir):
+        shutil.rmtree(outputs_dir)
+
+
+def iter_test_suites(xml_file, work_dir):
+    """Yield the test suites of a junit report file.
+
+    The file is parsed incrementally, and each element is cleared once it is
+    built. The details of each test case are written to the report's details
+    file as soon as it is parsed, so only the test case being parsed is kept
+    in memory.
+
+    The details file calls `loadDetails(<report name>, <details>)`, so
+    report.html can load it on demand when opened from the file system.
+    """
+    remove_report_details(xml_file, work_dir)
+    report_name = get_report_name(xml_file)
+    suite = None
+    index = 0
+    with open(os.path.join(work_dir, REPORT_DETAILS_DIR, '{0}.js'.format(report_name)), 'w') as f:
+        f.write('loadDetails({0}, ['.format(json.dumps(report_name)))
+        for event, elem in ElementTree.iterparse(xml_file, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'testsuite':
+                    suite = build_test_suite(elem)
+                continue
+            if elem.tag == 'testcase':
+                case, details = build_test_case(elem, work_dir, report_name, index)
+                case.details_file = report_name
+                case.details_index = index
+                f.write('{0}{1}'.format(',\n' if index else '\n', json.dumps(details)))
+                index += 1
+                suite.testcases.append(case)
+                elem.clear()
+            elif elem.tag == 'testsuite':
+                suite.time = sum([x.time for x in suite.testcases])
+                elem.clear()
+                yield suite
+        f.write(']);\n')
+
+
+def parse_report_file(args):
+    """Return the records (see `suite_to_record`) of the test suites of a
+    junit report file, given as an (xml_file, work_dir) tuple (see
+    `parse_report_files`).
+    """
+    xml_file, work_dir = args
+    return [suite_to_record(x) for x in iter_test_suites(xml_file, work_dir)]
+
+
+def suite_to_record(suite):
+    """Return a compact JSON serializable record of a TestSuite: its counts,
+    time, details file, and a (name, classname, time, outcome, timed out,
+    details index) row per test case.
+    """
+    return {
+        'name': suite.name,
+        'tests': suite.tests,
+        'errors': suite.errors,
+        'failures': suite.failures,
+        'skipped': suite.skipped,
+        'time': suite.time,
+        'details_file': suite.testcases[0].details_file if suite.testcases else None,
+        'testcases': [[x.name, x.classname, x.time, x.outcome, x.timed_out, x.details_index]
+                      for x in suite.testcases]
+    }
+
+
+def suite_from_record(record):
+    """Return the TestSuite of a record created by `suite_to_record`."""
+    suite = TestSuite()
+    for attribute in ('name', 'tests', 'errors', 'failures', 'skipped', 'time'):
+        setattr(suite, attribute, record[attribute])
+    for name, classname, time, outcome, timed_out, details_index in record['testcases']:
+        case = TestCase()
+        case.name = name
+        case.classname = classname
+        case.time = time
+        case.outcome = outcome
+        case.timed_out = timed_out
+        case.passed = outcome not in ('failure', 'error')
+        case.details_file = record['details_file']
+        case.details_index = details_index
+        suite.testcases.append(case)
+    return suite
+
+
+def get_report_file_key(xml_file):
+    stat = os.stat(xml_file)
+    return [stat.st_size, stat.st_mtime]
+
+
+def read_report_cache(work_dir):
+    cache_file = os.path.join(work_dir, REPORT_CACHE_FILE)
+    if not os.path.exists(cache_file):
+        return {}
+    with open(cache_file, 'r') as f:
+        cache = json.loads(f.read())
+    if cache.get('version') != REPORT_CACHE_VERSION:
+        return {}
+    return cache['reports']
+
+
+def write_report_cache(work_dir, cache):
+    with open(os.path.join(work_dir, REPORT_CACHE_FILE), 'w') as f:
+        f.write(json.dumps({'version': REPORT_CACHE_VERSION, 'reports': cache}))
+
+
+def load_report_files(xml_files, work_dir, jobs=None, use_cache=True):
+    """Return the test suites of each of `xml_files`, in their order.
+
+    Only report files which are not in the work directory cache (or changed
+    since they were cached) are parsed (see `parse_report_files`), the rest
+    are loaded from the cache.
+    """
+    cache = read_report_cache(work_dir) if use_cache else {}
+    keys = dict((os.path.basename(x), get_report_file_key(x)) for x in xml_files)
+    changed_files = [x for x in xml_files
+                     if cache.get(os.path.basename(x), {}).get('key') != keys[os.path.basename(x)]
+                     or not os.path.exists(os.path.join(work_dir, REPORT_DETAILS_DIR,
+                                                        '{0}.js'.format(get_report_name(x))))]
+    if not os.path.exists(os.path.join(work_dir, REPORT_DETAILS_DIR)):
+        os.mkdir(os.path.join(work_dir, REPORT_DETAILS_DIR))
+    print('Parsing {0} new or changed report files ({1} cached)..'.format(
+        len(changed_files), len(xml_files) - len(changed_files)))
+    parsed_suites = dict(zip(changed_files, parse_report_files(changed_files, work_dir, jobs)))
+
+    new_cache = {}
+    suites = []
+    for xml_file in xml_files:
+        name = os.path.basename(xml_file)
+        if xml_file in parsed_suites:
+            new_cache[name] = {'key': keys[name], 'suites': parsed_suites[xml_file]}
+        else:
+            new_cache[name] = cache[name]
+        suites.append([suite_from_record(x) for x in new_cache[name]['suites']])
+    for name in cache:
+        if name not in new_cache:
+            remove_report_details(name, work_dir)
+
+    if use_cache:
+        write_report_cache(work_dir, new_cache)
+    return suites
+
+
+def parse_report_files(xml_files, work_dir, jobs=None):
+    """Parse `xml_files` using a pool of `jobs` processes (one per CPU by
+    default), and return the test suite records (see `suite_to_record`) of
+    each file in the order of `xml_files`. Workers only send these compact
+    records back, the test details are written to files while parsing.
+    """
+    jobs = min(jobs or multiprocessing.cpu_count(), len(xml_files))
+    tasks = [(x, work_dir) for x in xml_files]
+    if jobs <= 1:
+        return [parse_report_file(x) for x in tasks]
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(parse_report_file, tasks, chunksize=max(1, len(tasks) // (jobs * 4)))
+    finally:
+        pool.close()
+        pool.join()
+
+
 def merge_test_suites(testsuites):
     new_suites = []
     for server_suites in testsuites.values():
@@ -96,6 +357,13 @@ def seconds_to_timestamp(seconds):
     return '{0:0>2}:{1:0>2}:{2:0>2}'.format(hms[0], hms[1], hms[2])
 
 
+def is_time_budget_case(case):
+    """Return whether a test case is a placeholder of a module skipped for the
+    time budget (see run-tests.py `write_time_budget_report`), which did not run.
+    """
+    return case.classname.split('.')[-1] == TIME_BUDGET_TEST_CLASS
+
+
 def print_summary(testsuites):
     summary = TestSuite()
     fmt = '{0:15} {1:5} {2:6} {3:8} {4:7} {5}'
@@ -114,9 +382,12 @@ def print_summary(testsuites):
     print('----------------------------------------------------------')
     max_time = max([x.time for x in testsuites])
     print(fmt.format('', summary.tests, summary.errors, summary.failures, summary.skipped, seconds_to_timestamp(max_time).rjust(12)))
+    budget_skipped = len([x for suite in testsuites for x in suite.testcases if is_time_budget_case(x)])
+    if budget_skipped:
+        print('{0} test modules were skipped for the time budget.'.format(budget_skipped))
     colorama.init()
     print('')
-    if summary.errors == 0 and summary.failures == 0 and summary.skipped == 0:
+    if summary.errors == 0 and summary.failures == 0 and summary.skipped == budget_skipped:
         print(colorama.Fore.LIGHTGREEN_EX + 'PASSED!' + colorama.Fore.RESET)
     else:
         print(colorama.Fore.LIGHTRED_EX + 'FAILED!' + colorama.Fore.RESET)
@@ -124,8 +395,18 @@ def print_summary(testsuites):
     return summary
 
 
+def strip_junit_prefix(classname):
+    """Remove the `--junit-prefix="Server-<n>"` prefix from a test classname."""
+    return re.sub(r'^Server-\d+\.', '', classname)
+
+
 def extract_module_name(classname):
-    return '/'.join(classname.split('.')[:-1]) + '.py'
+    return '/'.join(strip_junit_prefix(classname).split('.')[:-1]) + '.py'
+
+
+def extract_test_id(classname, name):
+    """Return the pytest node id of a test case (as used for weights)."""
+    return '{0}::{1}::{2}'.format(extract_module_name(classname), classname.split('.')[-1], name)
 
 
 def print_time_per_test_module(testsuites, work_dir):
@@ -134,11 +415,17 @@ def print_time_per_test_module(testsuites, work_dir):
         suites.extend(server_suites)
     
     test_modules_time = {}
+    test_cases_time = {}
 
     for suite in suites:
         for case in suite.testcases:
+            if is_time_budget_case(case):
+                continue
             module_name = extract_module_name(case.classname)
 
+            test_id = extract_test_id(case.classname, case.name)
+            test_cases_time[test_id] = test_cases_time.get(test_id, 0) + case.time
+
             if module_name not in test_modules_time:
                 test_modules_time[module_name] = {
                     'time': 0,
@@ -150,7 +437,7 @@ def print_time_per_test_module(testsuites, work_dir):
             else:
                 test_modules_time[module_name]['classes'][case.classname] += case.time
 
-    max_module_name_length = max([len(x) for x in test_modules_time.keys()])
+    max_module_name_length = max([len(x) for x in test_modules_time.keys()] + [len('Module')])
 
     print('-' * (max_module_name_length + 11))
     print('{0}       Time'.format('Module'.ljust(max_module_name_length)))
@@ -163,27 +450,179 @@ def print_time_per_test_module(testsuites, work_dir):
                 print(' * {0}: {1}'.format(cls_name.split('.')[-1], seconds_to_timestamp(time)))
 
     test_modules_time = {k: v['time'] for k, v in test_modules_time.items()}
+    # Test cases weights are used for splitting modules which are too heavy for a single server.
+    test_modules_time.update(test_cases_time)
 
     with open('{0}/weights.json'.format(work_dir), 'w') as f:
         f.write(json.dumps(test_modules_time, indent=2))
    
 
-def create_html_report(work_dir):
+def append_durations_history(testsuites, history_file, work_dir):
+    """Append the duration of every test case to the `history_file` durations
+    history (see run-tests.py `read_durations_history`).
+
+    Appending the same work directory again replaces its run's records in
+    place, so the history stays ordered by run.
+    """
+    run_id = get_run_id(work_dir)
+    timestamp = datetime.datetime.utcnow().isoformat()
+    records = []
+    run_position = None
+    if os.path.exists(history_file):
+        with open(history_file, 'r') as f:
+            for line in f:
+                record = json.loads(line) if line.strip() else {}
+                if record.get('run') == run_id:
+                    if run_position is None:
+                        # Keep the run's original position and timestamp.
+                        run_position = len(records)
+                        timestamp = record.get('timestamp', timestamp)
+                    continue
+                records.append(line)
+    if run_position is None:
+        run_position = len(records)
+    run_records = []
+    for suite in testsuites:
+        for case in suite.testcases:
+            if is_time_budget_case(case):
+                # Modules skipped for the time budget did not run.
+                continue
+            record = {
+                'run': run_id,
+                'timestamp': timestamp,
+                'module': extract_module_name(case.classname),
+                'class': case.classname.split('.')[-1],
+                'test': case.name,
+                'duration': case.time,
+                'outcome': case.outcome
+            }
+            if case.timed_out:
+                # Left out of the durations statistics.
+                record['timed_out'] = True
+            run_records.append(json.dumps(record, sort_keys=True) + '\n')
+    print('Appending test durations of run {0} to {1}..'.format(run_id, history_file))
+    with open(history_file + '.tmp', 'w') as f:
+        f.writelines(records[:run_position])
+        f.writelines(run_records)
+        f.writelines(records[run_position:])
+    os.rename(history_file + '.tmp', history_file)
+
+
+def extract_server(classname):
+    """Return the server number of the `--junit-prefix="Server-<n>"` prefix
+    of a test classname, or None.
+    """
+    match = re.match(r'^Server-(\d+)\.', classname)
+    return int(match.group(1)) if match else None
+
+
+def get_run_id(work_dir):
+    """Return the id of the run of `work_dir` (created on first use)."""
+    run_id_file = os.path.join(work_dir, RUN_ID_FILE)
+    if os.path.exists(run_id_file):
+        with open(run_id_file, 'r') as f:
+            return f.read().strip()
+    run_id = uuid.uuid4().hex
+    with open(run_id_file, 'w') as f:
+        f.write(run_id)
+    return run_id
+
+
+def get_repository_revisions(work_dir):
+    """Return the revisions of the repositories the test servers ran, read
+    from the revisions files of the work directory (see run-tests.py).
+    """
+    revisions = {}
+    for revisions_file in sorted(glob.glob(os.path.join(work_dir, 'revisions-*.json'))):
+        with open(revisions_file, 'r') as f:
+            for repository, revision in json.loads(f.read()).items():
+                revisions.setdefault(repository, revision)
+    return revisions
+
+
+def get_repository_revision(work_dir, repository):
+    """Return the revision of `repository` if it is checked out in the work
+    directory (e.g. cloudify-premium, see itests.py), otherwise None.
+    """
+    repository_dir = os.path.join(work_dir, repository)
+    if not os.path.isdir(os.path.join(repository_dir, '.git')):
+        return None
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=repository_dir).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def add_timed_out_column(connection):
+    """Add the `timed_out` column to the results table of a warehouse created
+    before it was recorded.
+    """
+    columns = [x[1] for x in connection.execute('PRAGMA table_info(results)')]
+    if 'timed_out' not in columns:
+        connection.execute('ALTER TABLE results ADD COLUMN timed_out INTEGER DEFAULT 0')
+
+
+def append_to_warehouse(testsuites, warehouse_file, work_dir, config=None):
+    """Record the test cases of the work directory's run, along with the
+    branches of the repositories in `config` and their revisions (as reported
+    by the test servers, see `get_repository_revisions`), in the
+    `warehouse_file` SQLite database (see query-results.py).
+
+    Recording the same work directory again replaces its records.
+    """
+    run_id = get_run_id(work_dir)
+    print('Recording the test results of run {0} to {1}..'.format(run_id, warehouse_file))
+    rows = []
+    for suite in testsuites:
+        for case in suite.testcases:
+            if is_time_budget_case(case):
+                continue
+            rows.append((run_id, extract_server(case.classname), suite.name, extract_module_name(case.classname),
+                         case.classname.split('.')[-1], case.name, case.time, case.outcome, int(case.timed_out)))
+    connection = sqlite3.connect(warehouse_file)
+    try:
+        with connection:
+            connection.executescript(WAREHOUSE_SCHEMA)
+            add_timed_out_column(connection)
+            connection.execute('INSERT OR IGNORE INTO runs VALUES (?, ?)',
+                               (run_id, datetime.datetime.utcnow().isoformat()))
+            branches = (config or {}).get('repositories', {})
+            revisions = get_repository_revisions(work_dir)
+            for repository in sorted(set(branches) | set(revisions)):
+                revision = revisions.get(repository) or get_repository_revision(work_dir, repository)
+                connection.execute('INSERT OR REPLACE INTO run_repositories VALUES (?, ?, ?, ?)',
+                                   (run_id, repository, branches.get(repository), revision))
+            connection.execute('DELETE FROM results WHERE run = ?', (run_id,))
+            connection.executemany('INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    finally:
+        connection.close()
+
+
+def get_report_rows(testsuites):
+    """Return the test rows of report.html: name, classname, time, outcome,
+    and the details file and index of each test case (see `iter_test_suites`).
+    """
+    rows = []
+    for suite in testsuites:
+        for case in suite.testcases:
+            rows.append([case.name, case.classname, case.time, case.outcome, case.details_file, case.details_index])
+    return rows
+
+
+def create_html_report(work_dir, history_file=None, jobs=None, use_cache=True, warehouse_file=None,
+                       config_file=None):
 
-    xml_files = glob.glob('{0}/*.xml'.format(work_dir))
+    xml_files = sorted(glob.glob('{0}/*.xml'.format(work_dir)))
     print('Processing {0} report files..'.format(len(xml_files)))
 
     testsuites = {}
     testsuites_list = []
 
-    for xml_file in xml_files:
-
-        tree = ElementTree.parse(xml_file)
-        suite = build_test_suite(tree.getroot())
-
-        if suite.name not in testsuites:
-            testsuites[suite.name] = []
-        testsuites[suite.name].append(suite)
+    for file_suites in load_report_files(xml_files, work_dir, jobs, use_cache):
+        for suite in file_suites:
+            if suite.name not in testsuites:
+                testsuites[suite.name] = []
+            testsuites[suite.name].append(suite)
 
     if not xml_files:
         print('No xunit test reports found.')
@@ -193,19 +632,27 @@ def create_html_report(work_dir):
 
     testsuites = merge_test_suites(testsuites)
 
+    if history_file:
+        append_durations_history(testsuites, history_file, work_dir)
+
+    if warehouse_file:
+        config = None
+        if config_file:
+            with open(config_file, 'r') as f:
+                config = json.loads(f.read())
+        append_to_warehouse(testsuites, warehouse_file, work_dir, config)
+
     summary = print_summary(testsuites)
 
     with open('report.jinja2.html', 'r') as f:
         report_template = f.read()
                                         
-    rendered_template = jinja2.Template(report_template).render({
-        'testsuites': testsuites,
-        'summary': summary
-    })
-
     print('Creating {0}/report.html..'.format(work_dir))
-    with open('{0}/report.html'.format(work_dir), 'w') as f:
-        f.write(rendered_template)
+    jinja2.Template(report_template).stream({
+        'tests_json': json.dumps(get_report_rows(testsuites)).replace('</', '<\\/'),
+        'details_dir': REPORT_DETAILS_DIR,
+        'summary': summary
+    }).dump('{0}/report.html'.format(work_dir))
 
     print('Done!')
     
@@ -215,5 +662,18 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--work-dir', default='work', required=False,
                         help='Working directory to load xunit reports from.')
+    parser.add_argument('--history-file', required=False,
+                        help='A durations history file (*.jsonl) to append the test durations to.')
+    parser.add_argument('--jobs', type=int, required=False,
+                        help='The number of processes parsing the reports (default=the number of CPUs).')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Parse all the reports, rather than only those which are new or changed since the '
+                             'last time (the parsed reports are cached in the working directory).')
+    parser.add_argument('--warehouse', required=False,
+                        help='A SQLite database to record the test results in (see query-results.py).')
+    parser.add_argument('--config-file', required=False,
+                        help='Config file path (config.json), the branches of its repositories are recorded '
+                             'in the warehouse.')
     args = parser.parse_args()
-    create_html_report(args.work_dir)
\ No newline at end of file
+    create_html_report(args.work_dir, args.history_file, args.jobs, not args.no_cache, args.warehouse,
+                       args.config_file)
\ No newline at end of file
@@ -7,9 +7,15 @@ import uuid
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import uuid
 
+try:
+    from Queue import Queue, Empty
+except ImportError:
+    from queue import Queue, Empty
+
 from path import Path
 import jinja2
 
@@ -17,11 +23,21 @@ import jinja2
 TERRAFORM_TEMPLATE_FILE = 'openstack-env.jinja2.tf'
 TERRAFORM_OUTPUT_FILE = 'openstack-env.tf'
 WORK_DIR = Path.getcwd() / 'work'
+PREVIOUS_WORK_DIR = Path.getcwd() / 'work-previous'
+RERUN_REPORTS_DIR = 'rerun-reports'
 CONFIG_FILE_PATH = 'resources/config.json'
 WEIGHTS_FILE_PATH = 'resources/weights.json'
+HISTORY_FILE_PATH = 'resources/durations.jsonl'
+WAREHOUSE_FILE_PATH = 'resources/results.db'
+SPEED_FACTORS_FILE_PATH = 'resources/speed-factors.json'
+MAX_SPEED_FACTORS = 100
 PRIVATE_KEY_FILE = WORK_DIR / 'ssh_key.pem'
 PUBLIC_KEY_FILE = WORK_DIR / 'ssh_key.pem.pub'
 DEFAULT_PATTERN = 'test_*.py'
+QUEUE_SERVER_PORT = 8000
+EVENTS_FILE_NAME = 'events.jsonl'
+STRAGGLER_FACTOR = 2
+EVENTS_CHECK_INTERVAL = 30
 
 
 # TODO: handle terraform cleanup error (don't remove the work dir!)
@@ -39,15 +55,44 @@ def get_configuration():
     return _config
 
 
+def get_weights_file_path():
+    """Return the durations history file if one was recorded by previous runs,
+    otherwise the weights file.
+    """
+    if os.path.exists(HISTORY_FILE_PATH):
+        return HISTORY_FILE_PATH
+    return WEIGHTS_FILE_PATH
+
+
 def get_cloudify_premium_branch():
     return get_configuration()['repositories']['cloudify-premium']
 
 
+def move_previous_work_dir():
+    """Move the work directory of the previous run to `work-previous`, and
+    return the path its junit reports can be read from.
+    """
+    if not WORK_DIR.exists() or not WORK_DIR.files('*.xml'):
+        print('Validation error: no junit reports found in the work directory!')
+        sys.exit(1)
+    if PREVIOUS_WORK_DIR.exists():
+        shutil.rmtree(PREVIOUS_WORK_DIR)
+    print('Moving the previous work directory to: {0}'.format(PREVIOUS_WORK_DIR))
+    shutil.move(WORK_DIR, PREVIOUS_WORK_DIR)
+    return PREVIOUS_WORK_DIR
+
+
 def validate(args):
     if args.number_of_servers < 1 or args.number_of_servers > 10:
         print('Argument error: number_of_servers accepts a value between 1 to 10')
         sys.exit(1)
-    if WORK_DIR.exists():
+    if args.time_budget and args.dispatch == 'queue':
+        print('Argument error: time_budget cannot be used with the queue dispatch')
+        sys.exit(1)
+    if args.stable_assignment and args.dispatch == 'queue':
+        print('Argument error: stable_assignment cannot be used with the queue dispatch')
+        sys.exit(1)
+    if WORK_DIR.exists() and args.which != 'rerun':
         print('Validation error: work directory already exists!')
         sys.exit(1)
 
@@ -62,7 +107,8 @@ def create_ssh_keys():
 
 
 
-def deploy(number_of_servers, pattern, keep_servers):
+def deploy(number_of_servers, pattern, keep_servers, dispatch='static', single_session=False,
+           failures_first=False, max_failures=None, from_report=None, time_budget=None, calibrate=False, stable_assignment=False):
     print('Creating work directory: {0}'.format(WORK_DIR))
     os.mkdir(WORK_DIR)
 
@@ -75,7 +121,17 @@ def deploy(number_of_servers, pattern, keep_servers):
 
     rendered_template = jinja2.Template(terraform_template_content).render({
         'servers': range(number_of_servers),
-        'env': os.environ
+        'env': os.environ,
+        'dispatch': dispatch,
+        'weights_file': os.path.basename(get_weights_file_path()),
+        'single_session': single_session,
+        'failures_first': failures_first,
+        'max_failures': max_failures,
+        'from_report': from_report is not None,
+        'time_budget': time_budget,
+        'calibrate': calibrate,
+        'stable_assignment': stable_assignment,
+        'queue_server_port': QUEUE_SERVER_PORT
     })
 
 
@@ -103,7 +159,16 @@ def deploy(number_of_servers, pattern, keep_servers):
     print('Copying terraform scripts..')
     source_scripts_dir = os.path.join(os.getcwd(), 'resources')
     destination_scripts_dir = WORK_DIR / 'resources'
-    shutil.copytree(source_scripts_dir, destination_scripts_dir)
+    # The results warehouse and the speed factors are only used locally.
+    shutil.copytree(source_scripts_dir, destination_scripts_dir,
+                    ignore=shutil.ignore_patterns(os.path.basename(WAREHOUSE_FILE_PATH),
+                                                  os.path.basename(SPEED_FACTORS_FILE_PATH)))
+
+    if from_report:
+        print('Copying the junit reports of the previous run..')
+        os.mkdir(destination_scripts_dir / RERUN_REPORTS_DIR)
+        for report_file in Path(from_report).files('*.xml'):
+            shutil.copy(report_file, destination_scripts_dir / RERUN_REPORTS_DIR)
 
     with WORK_DIR:
         print('Cloning cloudify-premium..')
@@ -121,6 +186,34 @@ def deploy(number_of_servers, pattern, keep_servers):
             os.system('terraform destroy -force -var-file inputs.json')
 
 
+def record_speed_factors():
+    """Add the speed factors of the calibrated test servers to the speed
+    factors file (keeping the last MAX_SPEED_FACTORS), used to simulate a
+    mixed pool of servers.
+    """
+    calibration_files = WORK_DIR.files('calibration-*.json') if WORK_DIR.exists() else []
+    if not calibration_files:
+        return
+    speed_factors = []
+    if os.path.exists(SPEED_FACTORS_FILE_PATH):
+        with open(SPEED_FACTORS_FILE_PATH, 'r') as f:
+            speed_factors = json.loads(f.read())
+    recorded_factors = []
+    for calibration_file in sorted(calibration_files):
+        with open(calibration_file, 'r') as f:
+            speed_factor = json.loads(f.read())['speed_factor']
+        # Servers which were not calibrated along with the others have no
+        # speed factor.
+        if speed_factor is not None:
+            recorded_factors.append(speed_factor)
+    if not recorded_factors:
+        return
+    speed_factors.extend(recorded_factors)
+    print('Recording {0} speed factors to: {1}'.format(len(recorded_factors), SPEED_FACTORS_FILE_PATH))
+    with open(SPEED_FACTORS_FILE_PATH, 'w') as f:
+        f.write(json.dumps(speed_factors[-MAX_SPEED_FACTORS:], indent=2))
+
+
 def get_servers_ip_address():
     cmd = 'terraform output -json'.split(' ')
     with WORK_DIR:
@@ -135,6 +228,100 @@ def get_servers_ip_address():
     return ips
 
 
+def tail_events(command, events_queue):
+    """Put the lines printed by `command` (tailing an events file) in
+    `events_queue`, followed by None once it exits.
+    """
+    process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE)
+    for line in iter(process.stdout.readline, b''):
+        events_queue.put(line)
+    events_queue.put(None)
+
+
+def format_event(event):
+    modules = ', '.join(os.path.basename(x) for x in event.get('modules', []))
+    if event['event'] == 'scheduled':
+        return 'scheduled run {0} ({1}s): {2}'.format(event['run'], int(event['weight']), modules)
+    if event['event'] == 'started':
+        return 'started run {0} on slot {1}: {2}'.format(event['run'], event['slot'], modules)
+    if event['event'] == 'finished':
+        return '{0} run {1} in {2}s: {3}'.format(
+            'failed' if event['exit_code'] else 'passed', event['run'], int(event['duration']), modules)
+    if event['event'] == 'aborted':
+        return 'aborted after {0} failed runs'.format(event['failures'])
+    if event['event'] == 'server_finished':
+        return 'finished in {0}s (exit code {1})'.format(int(event['duration']), event['exit_code'])
+    return event['event']
+
+
+def watch_events(events_files=None):
+    """Print the events of all test servers as they run, warning about runs
+    taking over STRAGGLER_FACTOR times their weight.
+
+    Events are tailed from `events_files` or from the test servers (over SSH),
+    and the merged events are written to `work/events.jsonl`.
+    """
+    if events_files:
+        commands = ['tail -n +1 {0}'.format(x) for x in events_files]
+    else:
+        commands = ['ssh -oStrictHostKeyChecking=no -i {0} centos@{1} tail -n +1 -F {2}'.format(
+            PRIVATE_KEY_FILE, ip_address, EVENTS_FILE_NAME) for ip_address in get_servers_ip_address()]
+
+    events_queue = Queue()
+    for command in commands:
+        thread = threading.Thread(target=tail_events, args=(command, events_queue))
+        thread.daemon = True
+        thread.start()
+
+    merged_events_file = open(WORK_DIR / EVENTS_FILE_NAME, 'a') if WORK_DIR.exists() else None
+    weights = {}
+    running = {}
+    stragglers = set()
+    servers_progress = {}
+    ended = 0
+    while ended < len(commands) and len([x for x in servers_progress.values() if x['done']]) < len(commands):
+        try:
+            line = events_queue.get(timeout=EVENTS_CHECK_INTERVAL)
+        except Empty:
+            line = b''
+        if line is None:
+            ended += 1
+        elif line.strip():
+            try:
+                event = json.loads(line.decode('utf-8'))
+            except ValueError:
+                continue
+            if merged_events_file:
+                merged_events_file.write(line.decode('utf-8'))
+                merged_events_file.flush()
+            key = (event['server'], event.get('run'))
+            progress = servers_progress.setdefault(event['server'], {'scheduled': 0, 'finished': 0, 'done': False})
+            if event['event'] == 'scheduled':
+                weights[key] = event['weight']
+                progress['scheduled'] += 1
+            elif event['event'] == 'started':
+                running[key] = event
+            elif event['event'] == 'finished':
+                running.pop(key, None)
+                progress['finished'] += 1
+            elif event['event'] == 'server_finished':
+                progress['done'] = True
+            print('[Server-{0}] [{1}/{2}] {3}'.format(
+                event['server'], progress['finished'], progress['scheduled'], format_event(event)))
+
+        now = time.time()
+        for key, event in sorted(running.items()):
+            elapsed = now - event['time']
+            if key not in stragglers and key in weights and elapsed > STRAGGLER_FACTOR * weights[key]:
+                stragglers.add(key)
+                print('[Server-{0}] straggler: run {1} running for {2}s (weight {3}s): {4}'.format(
+                    key[0], key[1], int(elapsed), int(weights[key]),
+                    ', '.join(os.path.basename(x) for x in event['modules'])))
+
+    if merged_events_file:
+        merged_events_file.close()
+
+
 def destroy():
     print('Destroying the test environment..')
     with WORK_DIR:
@@ -154,15 +341,37 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
 
-    run_parser = subparsers.add_parser('run', help='Run integration tests')
-    run_parser.set_defaults(which='run')
-    run_parser.add_argument('-n', '--number-of-servers',
+    run_options_parser = argparse.ArgumentParser(add_help=False)
+    run_options_parser.add_argument('-n', '--number-of-servers',
                             help='The number of servers to create and distribute the tests to.',
                             type=int, required=True)
-    run_parser.add_argument('-p', '--pattern', type=str, required=False, default=DEFAULT_PATTERN,
+    run_options_parser.add_argument('-p', '--pattern', type=str, required=False, default=DEFAULT_PATTERN,
                             help='Test modules pattern to match (default=test_*.py).')
-    run_parser.add_argument('-k', '--keep-servers', action='store_true',
+    run_options_parser.add_argument('-k', '--keep-servers', action='store_true',
                             help='Keep test servers up (test servers are terminated by default).')
+    run_options_parser.add_argument('-d', '--dispatch', choices=['static', 'queue'], default='static',
+                            help='How test modules are distributed to servers: static - each server runs a '
+                                 'precalculated group, queue - servers pull the next module to run from a '
+                                 'queue served by the first server (default=static).')
+    run_options_parser.add_argument('--single-session', action='store_true',
+                            help='Run the test modules of each server in a single pytest session.')
+    run_options_parser.add_argument('--failures-first', action='store_true',
+                            help='Run the test modules most likely to fail first.')
+    run_options_parser.add_argument('--max-failures', type=int,
+                            help='Stop running tests once this number of test modules failed.')
+    run_options_parser.add_argument('--time-budget', type=int,
+                            help='Only run the most valuable test modules which fit within this number of seconds.')
+    run_options_parser.add_argument('--calibrate', action='store_true',
+                            help='Benchmark the test servers and scale the weights of each server by its speed.')
+    run_options_parser.add_argument('--stable-assignment', action='store_true',
+                            help='Keep most test modules on the same server index from run to run.')
+
+    run_parser = subparsers.add_parser('run', help='Run integration tests', parents=[run_options_parser])
+    run_parser.set_defaults(which='run')
+
+    rerun_parser = subparsers.add_parser('rerun', help='Rerun the tests which failed in the last run.',
+                                         parents=[run_options_parser])
+    rerun_parser.set_defaults(which='rerun')
 
     simulate_parser = subparsers.add_parser('simulate', help='Simulate servers distribution.')
     simulate_parser.set_defaults(which='simulate')
@@ -170,6 +379,21 @@ if __name__ == '__main__':
                                  help='The directory Cloudify repositories are checked-out in.')
     simulate_parser.add_argument('-p', '--pattern', type=str, required=False, default=DEFAULT_PATTERN,
                                  help='Test modules pattern to match (default=test_*.py).')
+    simulate_parser.add_argument('-s', '--slots', type=int, default=1,
+                                 help='The number of test modules to run at a time on each server (default=1).')
+    simulate_parser.add_argument('--max-servers', type=int, default=10,
+                                 help='The maximum number of servers to simulate (default=10).')
+    simulate_parser.add_argument('-t', '--trials', type=int, default=0,
+                                 help='The number of Monte Carlo trials to simulate, drawing durations from the '
+                                      'durations history (default=0).')
+    simulate_parser.add_argument('--target-time', type=int,
+                                 help='Recommend the smallest number of servers running the tests within this '
+                                      'number of seconds.')
+
+    events_parser = subparsers.add_parser('events', help='Watch the progress of the test servers.')
+    events_parser.set_defaults(which='events')
+    events_parser.add_argument('events_files', nargs='*',
+                               help='Events files to read (events are tailed from the test servers by default).')
 
     create_server_parser = subparsers.add_parser('create-server', help='Creates a test server.')
     create_server_parser.set_defaults(which='create_server')
@@ -185,15 +409,32 @@ if __name__ == '__main__':
     
     start = time.time()
 
-    if args.which == 'run':
+    if args.which in ('run', 'rerun'):
         validate(args)
-        deploy(args.number_of_servers, args.pattern, args.keep_servers)
-        os.system('python create-report.py')
+        from_report = move_previous_work_dir() if args.which == 'rerun' else None
+        deploy(args.number_of_servers, args.pattern, args.keep_servers, args.dispatch,
+               args.single_session, args.failures_first, args.max_failures, from_report, args.time_budget,
+               args.calibrate, args.stable_assignment)
+        record_speed_factors()
+        if args.which == 'rerun':
+            # A rerun only runs the failed tests, recording it would skew the
+            # modules weights and failure rates.
+            os.system('python create-report.py')
+        else:
+            os.system('python create-report.py --history-file {0} --warehouse {1} --config-file {2}'.format(
+                HISTORY_FILE_PATH, WAREHOUSE_FILE_PATH, CONFIG_FILE_PATH))
 
     elif args.which == 'simulate':
         os.system(
-            'python resources/run-tests.py --repos {0} --weights-file {1} --config-file {2} --pattern {3} --simulate'.format(
-                args.repos, WEIGHTS_FILE_PATH, CONFIG_FILE_PATH, args.pattern))
+            'python resources/run-tests.py --repos {0} --weights-file {1} --config-file {2} --pattern {3} --slots {4} '
+            '--max-servers {5} --trials {6} {7} {8} --simulate'.format(
+                args.repos, get_weights_file_path(), CONFIG_FILE_PATH, args.pattern, args.slots,
+                args.max_servers, args.trials,
+                '--target-time {0}'.format(args.target_time) if args.target_time else '',
+                '--speed-factors {0}'.format(SPEED_FACTORS_FILE_PATH)
+                if os.path.exists(SPEED_FACTORS_FILE_PATH) else ''))
+    elif args.which == 'events':
+        watch_events(args.events_files)
     elif args.which == 'destroy':
         destroy()
     elif args.which == 'create_server':
@@ -104,6 +104,10 @@ resource "openstack_compute_instance_v2" "server{{ loop.index0 }}" {
   security_groups = ["${openstack_compute_secgroup_v2.security_group.name}"]
   network {
     uuid = "${openstack_networking_network_v2.network.id}"
+{% if (dispatch == 'queue' or calibrate or max_failures) and loop.first %}
+    # The queue server runs on this server, other servers connect to it using this address.
+    fixed_ip_v4 = "10.0.0.10"
+{% endif %}
   }
   floating_ip = "${openstack_networking_floatingip_v2.floatingip{{ loop.index0 }}.address}"
 
@@ -158,14 +162,21 @@ resource "openstack_compute_instance_v2" "server{{ loop.index0 }}" {
   }
 
   provisioner "file" {
-    source = "resources/weights.json"
-    destination = "/tmp/weights.json"
+    source = "resources/{{ weights_file }}"
+    destination = "/tmp/{{ weights_file }}"
   }
 
   provisioner "file" {
     source = "resources/wagons"
     destination = "/tmp"
   }
+{% if from_report %}
+
+  provisioner "file" {
+    source = "resources/rerun-reports"
+    destination = "/tmp"
+  }
+{% endif %}
 
   provisioner "file" {
     source = "resources/foo.rsa"
@@ -197,14 +208,24 @@ resource "openstack_compute_instance_v2" "server{{ loop.index0 }}" {
       "export openstack_username={{ env['OS_USERNAME'] }}",
       "export openstack_password={{ env['OS_PASSWORD'] }}",
       "export openstack_tenant_name={{ env['OS_PROJECT_NAME'] }}",
-      "python /tmp/run-tests.py --repos ~/dev/repos --group-number {{ loop.index }} --number-of-groups {{ servers|length }} --pattern ${var.tests_pattern} --weights-file /tmp/weights.json --config-file /tmp/config.json"
+{% if dispatch == 'queue' %}
+{% if loop.first %}
+      "nohup python /tmp/run-tests.py --repos ~/dev/repos --serve-queue {{ queue_server_port }}{% if failures_first %} --failures-first{% endif %} --pattern ${var.tests_pattern} --weights-file /tmp/{{ weights_file }} --config-file /tmp/config.json{% if from_report %} --from-report /tmp/rerun-reports{% endif %} > queue-server.txt 2>&1 &",
+{% endif %}
+      "python /tmp/run-tests.py --repos ~/dev/repos --group-number {{ loop.index }} --events-file ~/events.jsonl --queue-url http://10.0.0.10:{{ queue_server_port }}{% if calibrate %} --calibrate --calibration-url http://10.0.0.10:{{ queue_server_port }} --number-of-groups {{ servers|length }}{% endif %}{% if max_failures %} --max-failures {{ max_failures }}{% endif %} --pattern ${var.tests_pattern} --weights-file /tmp/{{ weights_file }} --config-file /tmp/config.json{% if from_report %} --from-report /tmp/rerun-reports{% endif %}"
+{% else %}
+{% if (calibrate or max_failures) and loop.first %}
+      "nohup python /tmp/run-tests.py --repos ~/dev/repos --serve-queue {{ queue_server_port }} --pattern ${var.tests_pattern} --weights-file /tmp/{{ weights_file }} --config-file /tmp/config.json > queue-server.txt 2>&1 &",
+{% endif %}
+      "python /tmp/run-tests.py --repos ~/dev/repos --group-number {{ loop.index }} --events-file ~/events.jsonl --number-of-groups {{ servers|length }}{% if calibrate %} --calibrate --calibration-url http://10.0.0.10:{{ queue_server_port }}{% endif %}{% if single_session %} --single-session{% endif %}{% if failures_first %} --failures-first{% endif %}{% if max_failures %} --max-failures {{ max_failures }} --failures-url http://10.0.0.10:{{ queue_server_port }}{% endif %}{% if time_budget %} --time-budget {{ time_budget }}{% endif %}{% if stable_assignment %} --stable-assignment{% endif %} --pattern ${var.tests_pattern} --weights-file /tmp/{{ weights_file }} --config-file /tmp/config.json{% if from_report %} --from-report /tmp/rerun-reports{% endif %}"
+{% endif %}
     ]
     on_failure = "continue"
   }
 
   provisioner "remote-exec" {
     inline = [
-      "tar czf report-{{ loop.index }}.tar.gz *.xml",
+      "tar czf report-{{ loop.index }}.tar.gz *.xml $(ls hang-*.txt calibration-*.json revisions-*.json 2> /dev/null)",
       "nohup python -m SimpleHTTPServer 8080 > output.txt 2>&1 &",
       "sleep 3"
     ]
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import sqlite3
+import sys
+
+
+DEFAULT_WAREHOUSE_FILE = 'resources/results.db'
+DEFAULT_RUNS = 10
+DEFAULT_LIMIT = 20
+FAILED_OUTCOMES = "('failure', 'error')"
+LAST_RUNS_QUERY = 'SELECT run FROM runs ORDER BY timestamp DESC LIMIT ?'
+
+
+def print_table(headers, formats, rows):
+    fmt = '  '.join(formats)
+    header = fmt.replace('.2f', '').format(*headers)
+    print('-' * len(header))
+    print(header)
+    print('-' * len(header))
+    for row in rows:
+        print(fmt.format(*row))
+    print('-' * len(header))
+
+
+def query_slowest(connection, runs, limit, modules=False):
+    """Print the slowest tests (or modules) by their mean duration in the
+    last `runs` runs, leaving out the runs killed on timeout.
+    """
+    if modules:
+        rows = connection.execute(
+            'SELECT module, COUNT(*), AVG(duration), MAX(duration) FROM ('
+            '  SELECT module, run, SUM(duration) AS duration FROM results'
+            '  WHERE run IN ({0}) AND NOT timed_out GROUP BY module, run'
+            ') GROUP BY module ORDER BY AVG(duration) DESC LIMIT ?'.format(LAST_RUNS_QUERY), (runs, limit))
+    else:
+        rows = connection.execute(
+            "SELECT module || '::' || class || '::' || test, COUNT(*), AVG(duration), MAX(duration) "
+            'FROM results WHERE run IN ({0}) AND NOT timed_out '
+            'GROUP BY module, class, test ORDER BY AVG(duration) DESC LIMIT ?'.format(LAST_RUNS_QUERY),
+            (runs, limit))
+    rows = list(rows)
+    width = max([len(x[0]) for x in rows] + [len('Test')])
+    print_table(['Module' if modules else 'Test', 'Runs', 'Mean', 'Max'],
+                ['{0:' + str(width) + '}', '{1:>5}', '{2:>10.2f}', '{3:>10.2f}'], rows)
+
+
+def query_trend(connection, pattern, runs):
+    """Print the number of tests, failures and total duration of the tests
+    matching `pattern` in each of the last `runs` runs, oldest first.
+    """
+    rows = connection.execute(
+        'SELECT runs.run, runs.timestamp, COUNT(*), SUM(outcome IN {0}), SUM(duration) '
+        'FROM results JOIN runs ON results.run = runs.run '
+        "WHERE module || '::' || class || '::' || test LIKE ? "
+        'GROUP BY runs.run ORDER BY runs.timestamp DESC LIMIT ?'.format(FAILED_OUTCOMES),
+        ('%{0}%'.format(pattern), runs))
+    print_table(['Run', 'Timestamp', 'Tests', 'Failures', 'Duration'],
+                ['{0:32}', '{1:26}', '{2:>6}', '{3:>8}', '{4:>10.2f}'], reversed(list(rows)))
+
+
+def query_throughput(connection, run=None):
+    """Print the number of modules and tests each server ran (in the last
+    run, or `run`), its busy time and the number of tests it ran per hour.
+    """
+    if run is None:
+        last_run = connection.execute(LAST_RUNS_QUERY, (1,)).fetchone()
+        if last_run is None:
+            print('No runs found.')
+            return
+        run = last_run[0]
+    rows = connection.execute(
+        'SELECT server, COUNT(DISTINCT module), COUNT(*), SUM(outcome IN {0}), SUM(duration) '
+        'FROM results WHERE run = ? GROUP BY server ORDER BY server'.format(FAILED_OUTCOMES), (run,))
+    print('Run: {0}'.format(run))
+    print_table(['Server', 'Modules', 'Tests', 'Failures', 'Busy', 'Tests/Hour'],
+                ['{0:>6}', '{1:>7}', '{2:>6}', '{3:>8}', '{4:>10.2f}', '{5:>10.2f}'],
+                [row + (3600.0 * row[2] / row[4] if row[4] else 0,) for row in rows])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Query the test results recorded by create-report.py --warehouse.')
+    parser.add_argument('--warehouse', default=DEFAULT_WAREHOUSE_FILE,
+                        help='The test results SQLite database (default={0}).'.format(DEFAULT_WAREHOUSE_FILE))
+    subparsers = parser.add_subparsers()
+
+    slowest_parser = subparsers.add_parser('slowest', help='The slowest tests by their mean duration.')
+    slowest_parser.set_defaults(which='slowest')
+    slowest_parser.add_argument('--runs', type=int, default=DEFAULT_RUNS,
+                                help='The number of last runs to query (default={0}).'.format(DEFAULT_RUNS))
+    slowest_parser.add_argument('-n', '--limit', type=int, default=DEFAULT_LIMIT,
+                                help='The number of tests to list (default={0}).'.format(DEFAULT_LIMIT))
+    slowest_parser.add_argument('--modules', action='store_true',
+                                help='List the slowest test modules rather than tests.')
+
+    trend_parser = subparsers.add_parser('trend', help='The duration of matching tests in each run.')
+    trend_parser.set_defaults(which='trend')
+    trend_parser.add_argument('pattern', help='A part of the test id (e.g. a module name) to match.')
+    trend_parser.add_argument('--runs', type=int, default=DEFAULT_RUNS,
+                              help='The number of last runs to query (default={0}).'.format(DEFAULT_RUNS))
+
+    throughput_parser = subparsers.add_parser('throughput', help='The tests each server ran in a run.')
+    throughput_parser.set_defaults(which='throughput')
+    throughput_parser.add_argument('--run', help='The run to query (default=the last run).')
+
+    args = parser.parse_args()
+    if not hasattr(args, 'which'):
+        parser.print_help()
+        sys.exit(1)
+
+    if not os.path.exists(args.warehouse):
+        print('Test results warehouse not found: {0}'.format(args.warehouse))
+        sys.exit(1)
+
+    connection = sqlite3.connect(args.warehouse)
+    try:
+        if args.which == 'slowest':
+            query_slowest(connection, args.runs, args.limit, args.modules)
+        elif args.which == 'trend':
+            query_trend(connection, args.pattern, args.runs)
+        elif args.which == 'throughput':
+            query_throughput(connection, args.run)
+    finally:
+        connection.close()
@@ -1,10 +1,64 @@
 #!/usr/bin/env python
 
-import argparse, datetime, os, fnmatch, json, sys
+import argparse, ast, bisect, datetime, os, fnmatch, hashlib, json, math, random, re, signal, socket, subprocess, sys, threading, time
+from xml.etree import ElementTree
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from urllib2 import urlopen, HTTPError, URLError
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from urllib.request import urlopen
+    from urllib.error import HTTPError, URLError
 
 
 DEFAULT_PATTERN = 'test_*.py'
 DEFAULT_WEIGHT = 100
+QUEUE_CONNECT_TIMEOUT = 1800
+QUEUE_CONNECT_INTERVAL = 10
+TEST_ID_SEPARATOR = '::'
+WEIGHTS_STATISTICS = ['last', 'mean', 'median', 'p90', 'ewma']
+DEFAULT_WEIGHTS_STATISTIC = 'median'
+EWMA_ALPHA = 0.3
+DEFAULT_MAX_SERVERS = 10
+SIMULATION_SEED = 0
+DISCOVERY_CACHE_FILE = '~/.cache/itests-runner/discovery.json'
+DEFAULT_CHANGED_SINCE = 'origin/master'
+# Matches the paths under a tests directory (e.g. tests/ or integration_tests/).
+TESTS_PATH_PATTERN = r'(^|/)\w*tests?/'
+# Matches the changed files which cannot affect the tests (documentation).
+NO_IMPACT_PATH_PATTERN = r'\.(md|rst)$'
+FAILED_OUTCOMES = ['failure', 'error']
+HANG_TIMEOUT_FACTOR = 3
+MIN_HANG_TIMEOUT = 1800
+HANG_KILL_GRACE_PERIOD = 30
+HANG_CONTAINER_LOG_LINES = 500
+TIMEOUT_TEST_CLASS = 'Timeout'
+# The junit error type of the test cases of a timed out run.
+TIMEOUT_ERROR_TYPE = 'timeout'
+TIME_BUDGET_TEST_CLASS = 'TimeBudget'
+# The files pytest takes its rootdir from, and the section they must have.
+PYTEST_INI_FILES = [('pytest.ini', None), ('tox.ini', '[pytest]'), ('setup.cfg', '[tool:pytest]')]
+NEW_MODULE_FAILURE_RATE = 0.5
+MIN_FAILURE_RATE = 0.01
+MIN_PREDICTION_SAMPLES = 10
+PREDICTION_RIDGE = 1.0
+MANAGER_BOOTSTRAP_COMMAND = 'docl run --mount'
+MANAGER_SNAPSHOT_IMAGE = 'itests-manager-snapshot'
+MANAGER_CONTAINER_NAME = 'itests-manager-{0}'
+MANAGER_READY_TIMEOUT = 300
+MANAGER_STATUS_URL = 'http://{0}/api/v3/status'
+CALIBRATION_FILE = '~/calibration-{0}.json'
+REVISIONS_FILE = '~/revisions-{0}.json'
+CALIBRATION_IMAGE = 'cloudify/centos:7'
+CALIBRATION_CPU_MEGABYTES = 512
+CALIBRATION_DISK_MEGABYTES = 128
+# The maximal number of moves of the local search refinement (see improve_groups).
+MAX_REFINE_MOVES = 1000
+STABLE_ASSIGNMENT_TOLERANCE = 0.1
+STABLE_ASSIGNMENT_REPLICAS = 64
+SLOT_NETWORK_NAME = 'itests-slot-{0}'
+SLOT_NETWORK_SUBNET = '172.21.{0}.0/24'
 
 
 def find_group_with_minimum_weight(group_weight):
@@ -15,10 +69,72 @@ def find_group_with_minimum_weight(group_weight):
     raise RuntimeError()
 
 
-def get_module_weight(weights, module_name):
-    """Return the module weight for `module_name` as listed in the `weights` dict.
-    If not found, return DEFAULT_WEIGHT.
-    
+def split_module_path(module_name):
+    """Return the normalized path components of `module_name`."""
+    return os.path.normpath(module_name).replace(os.sep, '/').strip('/').split('/')
+
+
+def build_weights_index(weights):
+    """Build a reverse path components trie from the `weights` dict.
+
+    Each trie node is a dict of path component -> child node, a node which
+    ends a weights key also holds its weight under the `None` key.
+    Test case weights (keys in the form of a pytest node id) are held by their
+    module node under the TEST_ID_SEPARATOR key.
+
+    For example:
+    weights = {
+        "agentless_tests/test_workflow.py": 123.51,
+        "agentless_tests/test_workflow.py::BasicWorkflowsTest::test_execute_operation": 10.3
+    }
+    index = {
+        "test_workflow.py": {
+            "agentless_tests": {
+                None: 123.51,
+                "::": {
+                    "BasicWorkflowsTest::test_execute_operation": 10.3
+                }
+            }
+        }
+    }
+    """
+    index = {}
+    for key, value in weights.items():
+        add_to_weights_index(index, key, value)
+    return index
+
+
+def add_to_weights_index(weights_index, key, value):
+    """Add a module (or test node id) weight to a weights index."""
+    module_name, _, test_id = key.partition(TEST_ID_SEPARATOR)
+    node = weights_index
+    for component in reversed(split_module_path(module_name)):
+        node = node.setdefault(component, {})
+    if test_id:
+        node.setdefault(TEST_ID_SEPARATOR, {})[test_id] = value
+    else:
+        node[None] = value
+
+
+def find_module_weights(weights_index, module_name):
+    """Return the weights index node of the longest weights key which is a
+    suffix of `module_name`, or None if there is no such key.
+    """
+    found = None
+    node = weights_index
+    for component in reversed(split_module_path(module_name)):
+        node = node.get(component)
+        if node is None:
+            break
+        if None in node:
+            found = node
+    return found
+
+
+def get_module_weight(weights_index, module_name):
+    """Return the module weight for `module_name` as listed in the weights
+    index (see `build_weights_index`). If not found, return DEFAULT_WEIGHT.
+
     For example:
     module_name = "integration_tests/tests/agentless_tests/test_workflow.py"
     weights = {
@@ -26,27 +142,418 @@ def get_module_weight(weights, module_name):
     }
 
     The modules in the weight files contains a shorter path as they are extracted
-    from the xunit report.
+    from the xunit report. When several weights keys are a suffix of the module
+    path, the longest one is used.
+
+    `module_name` may also be a pytest node id of a single test, in which case
+    the test weight is returned. Tests with no weight are given the average
+    weight of the module tests.
     """
-    for key, value in weights.items():
-        if module_name.endswith(key):
-            return value
-    else:
+    module_name, _, test_id = module_name.partition(TEST_ID_SEPARATOR)
+    module_weights = find_module_weights(weights_index, module_name)
+    if module_weights is None:
         return DEFAULT_WEIGHT
+    if not test_id:
+        return module_weights[None]
+    tests_weights = module_weights.get(TEST_ID_SEPARATOR, {})
+    if test_id in tests_weights:
+        return tests_weights[test_id]
+    if tests_weights:
+        return float(sum(tests_weights.values())) / len(tests_weights)
+    return DEFAULT_WEIGHT
 
-def split_modules_to_groups(test_modules, number_of_groups, weights):
-    group_weight = [0 for _ in range(number_of_groups)]
+
+def collect_module_test_ids(test_module):
+    """Return the node ids of the tests in `test_module` using pytest.
+
+    Returns None if the tests could not be collected.
+    """
+    try:
+        output = subprocess.check_output(['pytest', '--collect-only', '-q', test_module])
+    except (OSError, subprocess.CalledProcessError) as e:
+        print('# Could not collect tests of {0}: {1}'.format(test_module, e))
+        return None
+    test_ids = []
+    for line in output.decode('utf-8').splitlines():
+        if TEST_ID_SEPARATOR in line:
+            # Collected node ids are relative to pytest's rootdir.
+            test_ids.append('{0}{1}{2}'.format(
+                test_module, TEST_ID_SEPARATOR, line.strip().partition(TEST_ID_SEPARATOR)[2]))
+    return test_ids
+
+
+def get_module_test_ids(test_module, weights_index, collect_tests):
+    """Return the node ids of the tests in `test_module`.
+
+    Tests are collected using pytest if `collect_tests` is True, otherwise (or
+    if the collection fails) the tests listed in the weights index are used.
+    """
+    test_ids = collect_module_test_ids(test_module) if collect_tests else None
+    if test_ids is None:
+        module_weights = find_module_weights(weights_index, test_module) or {}
+        test_ids = ['{0}{1}{2}'.format(test_module, TEST_ID_SEPARATOR, x)
+                    for x in sorted(module_weights.get(TEST_ID_SEPARATOR, {}))]
+    return test_ids
+
+
+def split_oversized_modules(test_modules, number_of_groups, weights_index, collect_tests=True):
+    """Replace modules heavier than an even share of the total weight with
+    the node ids of their tests, so they can be spread across groups.
+    """
+    modules_weight = [get_module_weight(weights_index, m) for m in test_modules]
+    group_share = float(sum(modules_weight)) / number_of_groups
+    test_items = []
+    for module, module_weight in zip(test_modules, modules_weight):
+        if number_of_groups > 1 and module_weight > group_share:
+            test_ids = get_module_test_ids(module, weights_index, collect_tests)
+            if len(test_ids) > 1:
+                print('# Splitting {0} ({1:.2f} seconds) to {2} tests'.format(
+                    module, module_weight, len(test_ids)))
+                test_items.extend(test_ids)
+                continue
+        test_items.append(module)
+    return test_items
+
+
+def group_test_items(test_items):
+    """Return the pytest runs needed for running `test_items`.
+
+    Each run is a list of test items, node ids of tests from the same module
+    are merged to a single run (and therefore a single junit report).
+    """
+    runs = []
+    module_runs = {}
+    for item in test_items:
+        module_name = item.partition(TEST_ID_SEPARATOR)[0]
+        if item != module_name and module_name in module_runs:
+            module_runs[module_name].append(item)
+            continue
+        run = [item]
+        runs.append(run)
+        if item != module_name:
+            module_runs[module_name] = run
+    return runs
+
+
+def sort_modules_by_weight(test_modules, weights_index):
+    """Return (module, weight) pairs sorted by descending weight.
+
+    Ties are broken by module name so every server computes the exact same
+    order (and therefore the exact same groups).
+    """
+    weighted_modules = [(m, get_module_weight(weights_index, m)) for m in test_modules]
+    return sorted(weighted_modules, key=lambda x: (-x[1], x[0]))
+
+
+def improve_groups(modules_per_group, group_weight, weights_index, speed_factors=None, max_moves=MAX_REFINE_MOVES):
+    """Refine a groups split using local search.
+
+    Repeatedly tries to move a module out of the heaviest group, or to swap
+    it with the closest lighter module of another group, as long as this
+    lowers the weight of the heaviest group among the two involved. Stops
+    when no such move exists, or after `max_moves` moves, so the result is
+    never worse than the input split.
+    Group weights are compared scaled by the `speed_factors` of the groups.
+    """
+    number_of_groups = len(group_weight)
+    speed_factors = speed_factors or [1] * number_of_groups
+    # The modules of each group sorted by weight, for finding the lighter
+    # module to swap with by bisection.
+    weighted_groups = [sorted((get_module_weight(weights_index, x), x) for x in group)
+                       for group in modules_per_group]
+    for _ in range(max_moves):
+        scaled_weight = [w * f for w, f in zip(group_weight, speed_factors)]
+        max_index = scaled_weight.index(max(scaled_weight))
+        max_weight = scaled_weight[max_index]
+        move = None
+        for module_weight, module in weighted_groups[max_index]:
+            for group_index in range(number_of_groups):
+                if group_index == max_index:
+                    continue
+                # How much weight the group may take while staying lighter.
+                room = max_weight / speed_factors[group_index] - group_weight[group_index]
+                # Move the module to another group.
+                if module_weight < room:
+                    move = (module_weight, module, group_index, None)
+                    break
+                # Swap the module with a lighter one from another group.
+                i = bisect.bisect_left(weighted_groups[group_index], (module_weight,))
+                if i > 0 and module_weight - weighted_groups[group_index][i - 1][0] < room:
+                    move = (module_weight, module, group_index, weighted_groups[group_index][i - 1])
+                    break
+            if move:
+                break
+        if not move:
+            break
+        module_weight, module, group_index, other = move
+        weighted_groups[max_index].remove((module_weight, module))
+        modules_per_group[max_index].remove(module)
+        bisect.insort(weighted_groups[group_index], (module_weight, module))
+        modules_per_group[group_index].append(module)
+        delta = module_weight
+        if other:
+            weighted_groups[group_index].remove(other)
+            modules_per_group[group_index].remove(other[1])
+            bisect.insort(weighted_groups[max_index], other)
+            modules_per_group[max_index].append(other[1])
+            delta -= other[0]
+        group_weight[max_index] -= delta
+        group_weight[group_index] += delta
+    return modules_per_group, group_weight
+
+
+def get_module_setups(module_name, setups):
+    """Return the names of the setups (see the `setups` configuration) the
+    module (or test node id) `module_name` needs, sorted.
+    """
+    module_path = module_name.partition(TEST_ID_SEPARATOR)[0]
+    return tuple(sorted(name for name, setup in setups.items()
+                        if any(x in module_path for x in setup.get('modules', []))))
+
+
+def get_module_test_time(weights_index, module_name, setups):
+    """Return the weight of `module_name` excluding the cost of its setups.
+
+    Module weights are measured running each module in a pytest process of
+    its own, so they include the cost of the module's setups. Test node id
+    weights do not (see `get_module_weight`).
+    """
+    weight = get_module_weight(weights_index, module_name)
+    if TEST_ID_SEPARATOR in module_name:
+        return weight
+    return max(weight - sum(setups[x]['cost'] for x in get_module_setups(module_name, setups)), 0)
+
+
+def get_group_weight(modules, weights_index, setups):
+    """Return the weight of running `modules` in a single group, paying the
+    cost of each of their setups once.
+    """
+    group_setups = set(x for m in modules for x in get_module_setups(m, setups))
+    return sum(get_module_test_time(weights_index, m, setups) for m in modules) + \
+        sum(setups[x]['cost'] for x in group_setups)
+
+
+def split_modules_to_groups_by_setup(test_modules, number_of_groups, weights_index, setups, refine=True,
+                                     speed_factors=None):
+    """Split `test_modules` to `number_of_groups` groups of similar weight,
+    co-locating modules which share a setup so its cost is paid once.
+
+    Modules are assigned heaviest first, each to the group it would add the
+    least weight to (its test time, plus the cost of the setups the group
+    does not have yet). Optionally followed by moving modules out of the
+    heaviest group as long as this lowers the weight of the heaviest group
+    among the two involved.
+    Returns the group weights unscaled by `speed_factors`.
+    """
+    speed_factors = speed_factors or [1] * number_of_groups
     modules_per_group = [[] for _ in range(number_of_groups)]
+    group_weight = [0 for _ in range(number_of_groups)]
+    group_setups = [set() for _ in range(number_of_groups)]
+
+    for module, _ in sort_modules_by_weight(test_modules, weights_index):
+        test_time = get_module_test_time(weights_index, module, setups)
+        module_setups = get_module_setups(module, setups)
 
-    for module in test_modules:
-        module_weight = get_module_weight(weights, module)
-        group_index = find_group_with_minimum_weight(group_weight)
-        group_weight[group_index] += module_weight
+        def get_new_weight(group_index):
+            return group_weight[group_index] + test_time + \
+                sum(setups[x]['cost'] for x in module_setups if x not in group_setups[group_index])
+
+        group_index = min(range(number_of_groups), key=lambda i: (get_new_weight(i) * speed_factors[i], i))
+        group_weight[group_index] = get_new_weight(group_index)
+        group_setups[group_index].update(module_setups)
         modules_per_group[group_index].append(module)
 
+    improved = refine
+    while improved:
+        improved = False
+        scaled_weight = [w * f for w, f in zip(group_weight, speed_factors)]
+        max_index = scaled_weight.index(max(scaled_weight))
+        max_weight = scaled_weight[max_index]
+        for module in sorted(modules_per_group[max_index]):
+            remaining_modules = [m for m in modules_per_group[max_index] if m != module]
+            remaining_weight = get_group_weight(remaining_modules, weights_index, setups)
+            for group_index in range(number_of_groups):
+                if group_index == max_index:
+                    continue
+                new_weight = get_group_weight(modules_per_group[group_index] + [module], weights_index, setups)
+                if new_weight * speed_factors[group_index] < max_weight and \
+                        remaining_weight * speed_factors[max_index] < max_weight:
+                    modules_per_group[max_index] = remaining_modules
+                    modules_per_group[group_index].append(module)
+                    group_weight[max_index] = remaining_weight
+                    group_weight[group_index] = new_weight
+                    improved = True
+                    break
+            if improved:
+                break
+
     return modules_per_group, group_weight
 
 
+def split_modules_to_groups(test_modules, number_of_groups, weights_index, refine=True, setups=None,
+                            speed_factors=None):
+    """Split `test_modules` to `number_of_groups` groups of similar weight.
+
+    Uses the longest-processing-time-first heuristic (heaviest modules are
+    assigned first, each to the currently lightest group) optionally followed
+    by a local search refinement pass (see `improve_groups`).
+    When `setups` are configured, see `split_modules_to_groups_by_setup`.
+
+    When `speed_factors` (the relative running time on each group, see
+    `calibrate_server`) are given, modules are assigned to the group which would
+    finish them first, and the returned group weights are scaled by them.
+    """
+    if setups:
+        modules_per_group, group_weight = split_modules_to_groups_by_setup(
+            test_modules, number_of_groups, weights_index, setups, refine, speed_factors)
+    else:
+        group_weight = [0 for _ in range(number_of_groups)]
+        modules_per_group = [[] for _ in range(number_of_groups)]
+
+        for module, module_weight in sort_modules_by_weight(test_modules, weights_index):
+            if speed_factors:
+                group_index = min(range(number_of_groups),
+                                  key=lambda i: ((group_weight[i] + module_weight) * speed_factors[i], i))
+            else:
+                group_index = find_group_with_minimum_weight(group_weight)
+            group_weight[group_index] += module_weight
+            modules_per_group[group_index].append(module)
+
+        if refine:
+            improve_groups(modules_per_group, group_weight, weights_index, speed_factors)
+
+    if speed_factors:
+        group_weight = [w * f for w, f in zip(group_weight, speed_factors)]
+    return modules_per_group, group_weight
+
+
+def split_modules_to_servers(test_modules, number_of_groups, slots, weights_index, refine=True, setups=None,
+                             speed_factors=None):
+    """Split `test_modules` to `number_of_groups` servers running `slots`
+    modules at a time.
+
+    Each slot is scheduled as a group of its own (running at the speed factor
+    of its server, if `speed_factors` are given). Returns the modules per slot
+    for each server, and the weight of each slot.
+    """
+    slot_factors = [f for f in speed_factors for _ in range(slots)] if speed_factors else None
+    modules_per_slot, slot_weight = split_modules_to_groups(
+        test_modules, number_of_groups * slots, weights_index, refine, setups, slot_factors)
+    modules_per_group = [modules_per_slot[i:i + slots] for i in range(0, number_of_groups * slots, slots)]
+    return modules_per_group, slot_weight
+
+
+def get_ring_position(key):
+    """Return the position of `key` on the consistent hashing ring."""
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:8], 16)
+
+
+def split_modules_to_servers_stable(test_modules, number_of_groups, slots, weights_index, tolerance,
+                                    refine=True, setups=None, speed_factors=None):
+    """Split `test_modules` to `number_of_groups` servers running `slots`
+    modules at a time, keeping most modules on the same server from run to
+    run (so per-server caches can be reused).
+
+    Uses consistent hashing with bounded loads: servers are placed on a hash
+    ring (STABLE_ASSIGNMENT_REPLICAS times each), and each module (heaviest
+    first) is assigned to the first server following its own ring position
+    whose weight stays within `tolerance` above the weight of the servers in
+    the regular split (see `split_modules_to_servers`). Modules which fit no
+    server go to the server they add the least weight to. The modules of
+    each server are then split to its slots.
+    Returns the modules per slot for each server, and the weight of each slot.
+    """
+    setups = setups or {}
+    speed_factors = speed_factors or [1] * number_of_groups
+    _, slot_weight = split_modules_to_servers(test_modules, number_of_groups, slots, weights_index, refine, setups,
+                                              speed_factors)
+    capacity = (1 + tolerance) * max(slot_weight) * slots
+
+    ring = sorted((get_ring_position('server-{0}-{1}'.format(i, r)), i)
+                  for i in range(number_of_groups) for r in range(STABLE_ASSIGNMENT_REPLICAS))
+    ring_positions = [x for x, _ in ring]
+    modules_per_server = [[] for _ in range(number_of_groups)]
+    server_weight = [0 for _ in range(number_of_groups)]
+    server_setups = [set() for _ in range(number_of_groups)]
+
+    for module, _ in sort_modules_by_weight(test_modules, weights_index):
+        test_time = get_module_test_time(weights_index, module, setups)
+        module_setups = get_module_setups(module, setups)
+
+        def get_new_weight(group_index):
+            return server_weight[group_index] + test_time + \
+                sum(setups[x]['cost'] for x in module_setups if x not in server_setups[group_index])
+
+        start = bisect.bisect(ring_positions, get_ring_position(module))
+        candidates = []
+        for i in range(len(ring)):
+            group_index = ring[(start + i) % len(ring)][1]
+            if group_index not in candidates:
+                candidates.append(group_index)
+                if len(candidates) == number_of_groups:
+                    break
+        for group_index in candidates:
+            if get_new_weight(group_index) * speed_factors[group_index] <= capacity:
+                break
+        else:
+            group_index = min(range(number_of_groups), key=lambda i: (get_new_weight(i) * speed_factors[i], i))
+        server_weight[group_index] = get_new_weight(group_index)
+        server_setups[group_index].update(module_setups)
+        modules_per_server[group_index].append(module)
+
+    modules_per_group = []
+    slot_weight = []
+    for group_index, modules in enumerate(modules_per_server):
+        group_slots, group_slot_weight = split_modules_to_groups(
+            modules, slots, weights_index, refine, setups, [speed_factors[group_index]] * slots)
+        modules_per_group.append(group_slots)
+        slot_weight.extend(group_slot_weight)
+    return modules_per_group, slot_weight
+
+
+def get_group_test_runs(group_slots, weights_index, setups=None):
+    """Return the pytest runs (see `group_test_items`) of a server's slots,
+    heaviest first.
+
+    When `setups` are configured, runs sharing the same setups are kept
+    together (heaviest setups first) so each setup can be reused.
+    """
+    setups = setups or {}
+    test_runs = []
+    for slot_modules in group_slots:
+        test_runs.extend(group_test_items(slot_modules))
+
+    def get_run_weight(run):
+        return sum(get_module_weight(weights_index, x) for x in run)
+
+    def get_run_setups(run):
+        return get_module_setups(run[0], setups)
+
+    setups_weight = {}
+    for run in test_runs:
+        setups_weight[get_run_setups(run)] = setups_weight.get(get_run_setups(run), 0) + get_run_weight(run)
+    return sorted(test_runs, key=lambda run: (-setups_weight[get_run_setups(run)], get_run_setups(run),
+                                              -get_run_weight(run)))
+
+
+def get_makespan_lower_bound(test_modules, number_of_groups, weights_index, setups=None, speed_factors=None):
+    """Return the lower bound for the heaviest group weight in any split:
+    max(heaviest module, total weight / number_of_groups).
+
+    When `setups` are configured, the total weight includes the cost of each
+    setup once. When `speed_factors` are given, the heaviest module may run
+    on the fastest group, and the total weight is shared by the groups in
+    proportion to their speed.
+    """
+    setups = setups or {}
+    speed_factors = speed_factors or [1] * number_of_groups
+    modules_weight = [get_group_weight([m], weights_index, setups) for m in test_modules]
+    if not modules_weight:
+        return 0
+    total_weight = get_group_weight(test_modules, weights_index, setups)
+    return max(max(modules_weight) * min(speed_factors), float(total_weight) / sum(1.0 / f for f in speed_factors))
+
+
 def get_config(config_file):
     with open(config_file, 'r') as f:
         return json.loads(f.read())
@@ -55,32 +562,595 @@ def get_config(config_file):
 def get_test_modules_for_path(tests_path, pattern, excluded_modules):
     test_modules = []
     for root, dirs, files in os.walk(tests_path):
-        matching_files = [
-            os.path.join(root, x) for x in fnmatch.filter(files, pattern)
-        ]
-        for exclude in excluded_modules:
-            matching_files = [x for x in matching_files if exclude not in x]
-        test_modules.extend(matching_files)
+        # Everything under an excluded directory is excluded as well.
+        dirs[:] = sorted(x for x in dirs
+                         if not any(exclude in os.path.join(root, x) for exclude in excluded_modules))
+        test_modules.extend(
+            x for x in (os.path.join(root, f) for f in sorted(fnmatch.filter(files, pattern)))
+            if not any(exclude in x for exclude in excluded_modules))
     return test_modules
 
 
-def get_test_modules(config, pattern, repos_dir):
+def get_tests_path_revision(tests_path):
+    """Return an identifier of the revision of `tests_path` in its git
+    repository: the HEAD tree hash, and a digest of its uncommitted changes.
+
+    Returns None if `tests_path` is not in a git repository.
+    """
+    try:
+        with open(os.devnull, 'w') as devnull:
+            tree_hash = subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD^{tree}'], cwd=tests_path, stderr=devnull)
+            status = subprocess.check_output(
+                ['git', 'status', '--porcelain', '--untracked-files=all', '.'], cwd=tests_path, stderr=devnull)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return '{0}-{1}'.format(tree_hash.decode('utf-8').strip(), hashlib.sha1(status).hexdigest())
+
+
+def read_discovery_cache(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            return json.loads(f.read())
+    except (IOError, ValueError):
+        return {}
+
+
+def write_discovery_cache(cache_file, cache):
+    cache_dir = os.path.dirname(cache_file)
+    if cache_dir and not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    # Write and rename so that concurrent runs never read a partial file.
+    temp_file = '{0}.{1}'.format(cache_file, os.getpid())
+    with open(temp_file, 'w') as f:
+        f.write(json.dumps(cache, indent=2))
+    os.rename(temp_file, cache_file)
+
+
+def get_test_modules(config, pattern, repos_dir, cache_file=DISCOVERY_CACHE_FILE):
+    """Return the test modules matching `pattern` in the configured tests paths.
+
+    The modules found in each tests path are cached in `cache_file` (relative
+    to the tests path, so the cache holds for any `repos_dir` spelling), keyed
+    by the tests path revision (see `get_tests_path_revision`), the pattern
+    and the excluded modules, so they are only looked up again when one of
+    those changes.
+    """
     tests_path = config['tests_path']
     excluded_modules = config['excluded_modules']
+    cache_file = os.path.expanduser(cache_file) if cache_file else None
+    cache = read_discovery_cache(cache_file) if cache_file else {}
+    cache_changed = False
     test_modules = []
     for tp in tests_path:
-        tp_modules = get_test_modules_for_path(os.path.join(repos_dir, tp), pattern, excluded_modules)
+        path = os.path.abspath(os.path.join(repos_dir, tp))
+        revision = get_tests_path_revision(path) if cache_file and os.path.isdir(path) else None
+        key = hashlib.sha1(json.dumps([revision, pattern, excluded_modules]).encode('utf-8')).hexdigest()
+        if revision and cache.get(path, {}).get('key') == key and 'relative_modules' in cache[path]:
+            tp_modules = [os.path.join(repos_dir, tp, x) for x in cache[path]['relative_modules']]
+        else:
+            tp_modules = get_test_modules_for_path(os.path.join(repos_dir, tp), pattern, excluded_modules)
+            if revision:
+                cache[path] = {'key': key, 'relative_modules': [
+                    os.path.relpath(x, os.path.join(repos_dir, tp)) for x in tp_modules]}
+                cache_changed = True
         print('# Found the following modules for {0}: {1}'.format(tp, json.dumps(tp_modules, indent=2)))
         test_modules.extend(tp_modules)
+    if cache_changed:
+        write_discovery_cache(cache_file, cache)
     return test_modules
 
 
-def get_test_modules_weights(weights_file):
+def get_relative_path(path, repos_dir):
+    return os.path.relpath(path, repos_dir).replace(os.sep, '/')
+
+
+def get_python_modules_index(repos_dir, config):
+    """Return a dict of dotted python module name -> file path (relative to
+    `repos_dir`) for the configured repositories.
+
+    Module names are relative to the python package roots: the repositories
+    root directories and the directories containing a setup.py file.
+    """
+    modules_index = {}
+    for repo in sorted(config['repositories']):
+        repo_dir = os.path.join(repos_dir, repo)
+        package_roots = []
+        for root, dirs, files in os.walk(repo_dir):
+            dirs[:] = sorted(x for x in dirs if not x.startswith('.'))
+            if root == repo_dir or 'setup.py' in files:
+                package_roots.append(root)
+        for package_root in package_roots:
+            for root, dirs, files in os.walk(package_root):
+                dirs[:] = sorted(x for x in dirs if not x.startswith('.'))
+                for f in fnmatch.filter(files, '*.py'):
+                    path = os.path.relpath(os.path.join(root, f), package_root)
+                    name = os.path.splitext(path)[0].replace(os.sep, '.')
+                    if name.endswith('.__init__'):
+                        name = name[:-len('.__init__')]
+                    modules_index.setdefault(name, get_relative_path(os.path.join(root, f), repos_dir))
+    return modules_index
+
+
+def get_imported_modules(file_path, module_name, is_package=False):
+    """Return the candidate dotted names of the modules imported by a python
+    file (`module_name`, and whether the file is a package's `__init__.py`,
+    are used for resolving relative imports).
+    """
+    try:
+        with open(file_path, 'r') as f:
+            tree = ast.parse(f.read(), file_path)
+    except (IOError, SyntaxError, ValueError):
+        return []
+    package = module_name.split('.') if is_package else module_name.split('.')[:-1]
+    names = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            names.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom):
+            base = node.module or ''
+            if node.level:
+                base_package = package[:len(package) - node.level + 1]
+                base = '.'.join(base_package + ([base] if base else []))
+            names.append(base)
+            names.extend('{0}.{1}'.format(base, alias.name) for alias in node.names)
+    # Importing a.b.c imports the a and a.b packages as well.
+    candidates = set()
+    for name in names:
+        parts = name.split('.')
+        candidates.update('.'.join(parts[:i]) for i in range(1, len(parts) + 1))
+        # Implicit relative imports (python 2).
+        candidates.add('.'.join(package + parts))
+    return candidates
+
+
+def get_module_impact(test_module, repos_dir, modules_index, files_index):
+    """Return the files (relative to `repos_dir`) a test module depends on: the
+    closure of its imports within the repositories and the conftest.py files
+    applying to it.
+    """
+    module_path = get_relative_path(test_module, repos_dir)
+    impact = set([module_path])
+    pending = [module_path]
+    while pending:
+        path = pending.pop()
+        for name in get_imported_modules(os.path.join(repos_dir, path), files_index.get(path, ''),
+                                         os.path.basename(path) == '__init__.py'):
+            imported_path = modules_index.get(name)
+            if imported_path and imported_path not in impact:
+                impact.add(imported_path)
+                pending.append(imported_path)
+    parts = module_path.split('/')
+    for i in range(1, len(parts)):
+        conftest = '/'.join(parts[:i] + ['conftest.py'])
+        if os.path.isfile(os.path.join(repos_dir, conftest)):
+            impact.add(conftest)
+    return sorted(impact)
+
+
+def record_impact_map(test_modules, repos_dir, config, impact_map_file):
+    """Write the files each test module depends on (see `get_module_impact`)
+    to `impact_map_file`.
+    """
+    modules_index = get_python_modules_index(repos_dir, config)
+    files_index = {v: k for k, v in modules_index.items()}
+    impact_map = {}
+    for test_module in test_modules:
+        impact_map[get_relative_path(test_module, repos_dir)] = get_module_impact(
+            test_module, repos_dir, modules_index, files_index)
+    print('# Writing the impact map of {0} test modules to {1}'.format(len(impact_map), impact_map_file))
+    with open(impact_map_file, 'w') as f:
+        f.write(json.dumps(impact_map, indent=2, sort_keys=True))
+
+
+def get_changed_files(repos_dir, config, changed_since):
+    """Return the files (relative to `repos_dir`) changed in the configured
+    repositories since their merge base with `changed_since`.
+    """
+    changed_files = []
+    for repo in sorted(config['repositories']):
+        try:
+            with open(os.devnull, 'w') as devnull:
+                output = subprocess.check_output(
+                    ['git', 'diff', '--name-only', '--relative', '{0}...HEAD'.format(changed_since)],
+                    cwd=os.path.join(repos_dir, repo), stderr=devnull)
+        except (OSError, subprocess.CalledProcessError):
+            print('# Could not get the changes of {0} since {1}, skipping it'.format(repo, changed_since))
+            continue
+        changed_files.extend('{0}/{1}'.format(repo, x) for x in output.decode('utf-8').splitlines() if x)
+    return changed_files
+
+
+def select_impacted_modules(test_modules, repos_dir, config, impact_map_file, changed_since, narrow=False):
+    """Return the test modules affected by the changes made since
+    `changed_since` according to the impact map (see `record_impact_map`).
+
+    Modules missing from the impact map (e.g. new modules) and the modules
+    matching the `safety_modules` configuration are always selected, and all
+    the modules are selected when a changed file is not imported by any test
+    module (e.g. manager service code, or a blueprint used by the tests), as
+    its impact is unknown. With `narrow`, such files are left to the safety
+    modules, unless they are under a tests directory.
+    """
+    with open(impact_map_file, 'r') as f:
+        impact_map = json.loads(f.read())
+    changed_files = set(get_changed_files(repos_dir, config, changed_since))
+    safety_modules = config.get('safety_modules', [])
+
+    mapped_files = set(f for files in impact_map.values() for f in files)
+    unmapped_files = sorted(x for x in changed_files - mapped_files if not re.search(NO_IMPACT_PATH_PATTERN, x))
+    print('# Changed files not imported by any test module: {0}'.format(json.dumps(unmapped_files, indent=2)))
+    if narrow:
+        unmapped_files = [x for x in unmapped_files if re.search(TESTS_PATH_PATTERN, x)]
+    if unmapped_files:
+        print('# Selected all {0} test modules for the changed files not imported by any test module'.format(
+            len(test_modules)))
+        return test_modules
+
+    selected_modules = []
+    for test_module in test_modules:
+        module_impact = impact_map.get(get_relative_path(test_module, repos_dir))
+        if module_impact is None \
+                or changed_files.intersection(module_impact) \
+                or any(x in test_module for x in safety_modules):
+            selected_modules.append(test_module)
+
+    print('# Selected {0} of {1} test modules for {2} changed files since {3}'.format(
+        len(selected_modules), len(test_modules), len(changed_files), changed_since))
+    return selected_modules
+
+
+def get_failed_test_ids(report_dir):
+    """Return the node ids of the failed and errored tests in the junit
+    reports found in `report_dir`, parsed the same way as create-report.py
+    `build_test_case`.
+
+    Node ids are relative to the pytest rootdir the reports were written in,
+    a module failing to be collected (or timing out) is returned as a whole.
+    """
+    test_ids = set()
+    for report_file in sorted(os.listdir(report_dir)):
+        if not report_file.endswith('.xml'):
+            continue
+        for testcase in ElementTree.parse(os.path.join(report_dir, report_file)).getroot().iter('testcase'):
+            if not any(elem.tag in ('error', 'failure') for elem in testcase):
+                continue
+            classname = re.sub(r'^Server-\d+\.?', '', testcase.attrib.get('classname', ''))
+            if not classname:
+                test_ids.add(testcase.attrib['name'].replace('.', '/') + '.py')
+                continue
+            module_name = '/'.join(classname.split('.')[:-1]) + '.py'
+            if classname.split('.')[-1] == TIMEOUT_TEST_CLASS:
+                # A timed out module (see `HangWatchdog`).
+                test_ids.add(module_name)
+                continue
+            test_ids.add(TEST_ID_SEPARATOR.join([module_name, classname.split('.')[-1], testcase.attrib['name']]))
+    return sorted(test_ids)
+
+
+def select_failed_tests(test_modules, report_dir):
+    """Return the node ids of the tests of `test_modules` which failed in
+    the junit reports found in `report_dir` (see `get_failed_test_ids`).
+
+    Exits with an error when there are failed tests but none of them is
+    found in `test_modules`, rather than running no tests at all.
+    """
+    modules_path = [(m, split_module_path(m)) for m in test_modules]
+    failed_test_ids = get_failed_test_ids(report_dir)
+    selected_tests = []
+    missing_tests = []
+    for test_id in failed_test_ids:
+        module_name, separator, test_name = test_id.partition(TEST_ID_SEPARATOR)
+        suffix = split_module_path(module_name)
+        matching_modules = [m for m, path in modules_path if path[-len(suffix):] == suffix]
+        if not matching_modules:
+            missing_tests.append(test_id)
+        selected_tests.extend(m + separator + test_name for m in matching_modules)
+    if missing_tests:
+        print('# {0} of {1} failed tests were not found in the test modules: {2}'.format(
+            len(missing_tests), len(failed_test_ids), json.dumps(missing_tests, indent=2)))
+    if failed_test_ids and not selected_tests:
+        print('# None of the failed tests in {0} were found, not running any tests'.format(report_dir))
+        sys.exit(1)
+    print('# Selected {0} failed tests from {1}: {2}'.format(
+        len(selected_tests), report_dir, json.dumps(selected_tests, indent=2)))
+    return selected_tests
+
+
+def select_modules_within_budget(test_modules, number_of_groups, slots, weights_index, failures_index,
+                                 time_budget, mandatory_modules, refine=True, setups=None, speed_factors=None):
+    """Select the subset of `test_modules` with the most value which can run
+    on `number_of_groups` servers (running `slots` modules at a time) within
+    `time_budget` seconds.
+
+    The value of a module is its failure rate per second of running time
+    (modules with no history are assumed to fail at NEW_MODULE_FAILURE_RATE).
+    Modules matching `mandatory_modules` are always selected, and the rest
+    are selected by their value as long as they fit, dropping the least
+    valuable ones until the split of the selected modules fits the budget.
+    Returns the selected modules and the skipped modules.
+    """
+    def get_value(module):
+        failure_rate = get_module_history(failures_index, module)
+        if failure_rate is None:
+            failure_rate = NEW_MODULE_FAILURE_RATE
+        return max(failure_rate, MIN_FAILURE_RATE) / max(get_module_weight(weights_index, module), 1)
+
+    mandatory = [m for m in test_modules if any(x in m for x in mandatory_modules)]
+    optional = sorted(set(test_modules) - set(mandatory), key=lambda m: (-get_value(m), m))
+    capacity = time_budget * number_of_groups * slots
+    selected = list(mandatory)
+    selected_weight = sum(get_module_weight(weights_index, m) for m in mandatory)
+    for module in optional:
+        module_weight = get_module_weight(weights_index, module)
+        if module_weight <= time_budget and selected_weight + module_weight <= capacity:
+            selected.append(module)
+            selected_weight += module_weight
+
+    # Mandatory modules may not fit the budget by themselves.
+    _, slot_weight = split_modules_to_servers(mandatory, number_of_groups, slots, weights_index, refine, setups,
+                                              speed_factors)
+    max_weight = max([time_budget] + slot_weight)
+    while True:
+        _, slot_weight = split_modules_to_servers(selected, number_of_groups, slots, weights_index, refine, setups,
+                                                  speed_factors)
+        selected_optional = [m for m in selected if m not in mandatory]
+        if max(slot_weight) <= max_weight or not selected_optional:
+            break
+        selected.remove(min(selected_optional, key=lambda m: (get_value(m), m)))
+
+    selected_modules = set(selected)
+    skipped = [m for m in test_modules if m not in selected_modules]
+    print('# Selected {0} of {1} test modules within the {2} seconds time budget, skipped: {3}'.format(
+        len(selected), len(test_modules), time_budget, json.dumps(skipped, indent=2)))
+    return [m for m in test_modules if m in selected_modules], skipped
+
+
+def get_percentile(values, percent):
+    """Return the `percent` percentile of `values` (nearest rank)."""
+    sorted_values = sorted(values)
+    return sorted_values[max(int(math.ceil(percent / 100.0 * len(sorted_values))) - 1, 0)]
+
+
+def get_statistic(values, statistic):
+    """Return the `statistic` (one of WEIGHTS_STATISTICS) of `values`, which
+    are ordered from the oldest to the newest.
+    """
+    if statistic == 'last':
+        return values[-1]
+    if statistic == 'mean':
+        return float(sum(values)) / len(values)
+    if statistic == 'ewma':
+        average = values[0]
+        for value in values[1:]:
+            average = EWMA_ALPHA * value + (1 - EWMA_ALPHA) * average
+        return average
+    sorted_values = sorted(values)
+    if statistic == 'median':
+        middle = len(sorted_values) // 2
+        if len(sorted_values) % 2:
+            return sorted_values[middle]
+        return (sorted_values[middle - 1] + sorted_values[middle]) / 2.0
+    if statistic == 'p90':
+        return get_percentile(sorted_values, 90)
+    raise ValueError('Unknown statistic: {0}'.format(statistic))
+
+
+def iter_history_records(history_file):
+    """Yield the records of a durations history file (as appended to by
+    create-report.py) along with their module and test node id keys.
+
+    Each line in the file is a JSON record of a single test case run:
+    {"run": "...", "module": "agentless_tests/test_workflow.py",
+     "class": "BasicWorkflowsTest", "test": "test_execute_operation",
+     "duration": 10.3, "outcome": "passed"}
+
+    Records of runs killed on timeout (see `HangWatchdog`) are marked with
+    "timed_out": true.
+    """
+    with open(history_file, 'r') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            test_id = TEST_ID_SEPARATOR.join([record['module'], record['class'], record['test']])
+            yield record, (record['module'], test_id)
+
+
+def read_durations_history(history_file):
+    """Read a durations history file (see `iter_history_records`).
+
+    Returns a dict of module / test node id -> list of its durations per run,
+    ordered from the oldest run to the newest. Timed out runs are left out, as
+    their duration is the timeout rather than the time they take.
+    """
+    durations = {}
+    for record, keys in iter_history_records(history_file):
+        if record.get('timed_out'):
+            continue
+        for key in keys:
+            runs = durations.setdefault(key, {})
+            if record['run'] not in runs:
+                runs[record['run']] = [len(runs), 0]
+            runs[record['run']][1] += record['duration']
+    return {k: [d for _, d in sorted(v.values())] for k, v in durations.items()}
+
+
+def read_failure_rates(history_file):
+    """Read a durations history file (see `iter_history_records`).
+
+    Returns a dict of module / test node id -> the fraction of the runs it
+    failed in.
+    """
+    failures = {}
+    for record, keys in iter_history_records(history_file):
+        failed = record.get('outcome') in FAILED_OUTCOMES
+        for key in keys:
+            runs = failures.setdefault(key, {})
+            runs[record['run']] = runs.get(record['run'], False) or failed
+    return {k: float(sum(v.values())) / len(v) for k, v in failures.items()}
+
+
+def get_test_modules_durations(weights_file):
+    """Return an index (see `build_weights_index`) of the durations per run of
+    each module and test, for a durations history `weights_file` (*.jsonl).
+    Returns an empty index for a JSON weights file.
+    """
+    if weights_file and weights_file.endswith('.jsonl'):
+        return build_weights_index(read_durations_history(weights_file))
+    return build_weights_index({})
+
+
+def get_test_modules_failure_rates(weights_file):
+    """Return an index (see `build_weights_index`) of the failure rate of each
+    module and test, for a durations history `weights_file` (*.jsonl).
+    Returns an empty index for a JSON weights file.
+    """
+    if weights_file and weights_file.endswith('.jsonl'):
+        return build_weights_index(read_failure_rates(weights_file))
+    return build_weights_index({})
+
+
+def get_module_history(history_index, module_name):
+    """Return the value (e.g. durations per run) of a module or a test node id
+    in a history index, or None if it is not listed.
+    """
+    module_name, _, test_id = module_name.partition(TEST_ID_SEPARATOR)
+    module_history = find_module_weights(history_index, module_name)
+    if module_history is None:
+        return None
+    if not test_id:
+        return module_history[None]
+    return module_history.get(TEST_ID_SEPARATOR, {}).get(test_id)
+
+
+def get_failure_probability(failures_index, test_items):
+    """Return the probability of at least one of `test_items` failing."""
+    pass_probability = 1.0
+    for item in test_items:
+        pass_probability *= 1 - (get_module_history(failures_index, item) or 0)
+    return 1 - pass_probability
+
+
+def order_by_failure_probability(test_runs, weights_index, failures_index):
+    """Order `test_runs` (see `group_test_items`) by their failure probability
+    per second of running time, so likely failures show up first.
+    Runs with no failures history are left last, heaviest first.
+    """
+    def run_key(test_items):
+        weight = sum(get_module_weight(weights_index, x) for x in test_items)
+        return -get_failure_probability(failures_index, test_items) / max(weight, 1), -weight
+    return sorted(test_runs, key=run_key)
+
+
+def get_test_modules_weights(weights_file, weights_statistic=DEFAULT_WEIGHTS_STATISTIC):
+    """Return the weights index (see `build_weights_index`) for `weights_file`.
+
+    `weights_file` is either a JSON weights file or a durations history file
+    (*.jsonl), in which case the weights are the `weights_statistic` of the
+    durations of each module and test.
+    """
     weights = {}
-    if weights_file:
+    if weights_file and weights_file.endswith('.jsonl'):
+        weights = {k: get_statistic(v, weights_statistic)
+                   for k, v in read_durations_history(weights_file).items()}
+    elif weights_file:
         with open(weights_file, 'r') as f:
             weights = json.loads(f.read())
-    return weights
+    return build_weights_index(weights)
+
+
+def get_module_features(test_module):
+    """Return the static features of a test module used for predicting its
+    weight: its directory, and its number of tests, size and number of
+    fixtures used by its tests.
+    """
+    features = {'directory': os.path.basename(os.path.dirname(test_module)), 'tests': 0, 'fixtures': 0, 'size': 0}
+    try:
+        with open(test_module, 'r') as f:
+            content = f.read()
+        tree = ast.parse(content, test_module)
+    except (IOError, SyntaxError, ValueError):
+        return features
+    features['size'] = len(content)
+    fixtures = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.FunctionDef) and node.name.startswith('test'):
+            features['tests'] += 1
+            fixtures.update(getattr(x, 'arg', getattr(x, 'id', None)) for x in node.args.args)
+    fixtures.discard('self')
+    features['fixtures'] = len(fixtures)
+    return features
+
+
+def get_features_vector(features, directories):
+    """Return the regression inputs for module `features`: an intercept, the
+    log of its numeric features, and a one-hot encoding of its directory.
+    """
+    return [1.0, math.log1p(features['tests']), math.log1p(features['size'] / 1024.0),
+            math.log1p(features['fixtures'])] + [float(features['directory'] == x) for x in directories]
+
+
+def solve_linear_system(a, b):
+    """Solve `a` x = `b` using Gaussian elimination with partial pivoting."""
+    n = len(b)
+    m = [list(row) + [value] for row, value in zip(a, b)]
+    for i in range(n):
+        pivot = max(range(i, n), key=lambda r: abs(m[r][i]))
+        m[i], m[pivot] = m[pivot], m[i]
+        for r in range(i + 1, n):
+            factor = m[r][i] / m[i][i]
+            for c in range(i, n + 1):
+                m[r][c] -= factor * m[i][c]
+    x = [0.0] * n
+    for i in reversed(range(n)):
+        x[i] = (m[i][n] - sum(m[i][c] * x[c] for c in range(i + 1, n))) / m[i][i]
+    return x
+
+
+def predict_module_weights(test_modules, weights_index):
+    """Predict the weights of the test modules which have no weight, using a
+    log-linear ridge regression over their static features (see
+    `get_module_features`) fitted on the modules which have weights.
+
+    Returns a dict of module -> predicted weight (empty when there are fewer
+    than MIN_PREDICTION_SAMPLES modules to fit the model on).
+    """
+    modules = [m for m in test_modules if TEST_ID_SEPARATOR not in m]
+    known = [(m, get_module_features(m)) for m in modules if find_module_weights(weights_index, m) is not None]
+    unknown = [m for m in modules if find_module_weights(weights_index, m) is None]
+    if not unknown or len(known) < MIN_PREDICTION_SAMPLES:
+        return {}
+
+    directories = sorted(set(features['directory'] for _, features in known))
+    xs = [get_features_vector(features, directories) for _, features in known]
+    ys = [math.log(max(get_module_weight(weights_index, m), 1)) for m, _ in known]
+    size = len(xs[0])
+    # The intercept is not regularized.
+    a = [[sum(x[i] * x[j] for x in xs) + (PREDICTION_RIDGE if i == j and i else 0) for j in range(size)]
+         for i in range(size)]
+    b = [sum(x[i] * y for x, y in zip(xs, ys)) for i in range(size)]
+    coefficients = solve_linear_system(a, b)
+
+    predictions = {}
+    for m in unknown:
+        x = get_features_vector(get_module_features(m), directories)
+        predictions[m] = math.exp(sum(c * v for c, v in zip(coefficients, x)))
+    return predictions
+
+
+def add_predicted_weights(test_modules, weights_index):
+    """Add the predicted weights of the test modules which have no weight
+    (see `predict_module_weights`) to `weights_index`.
+
+    Returns a dict of module -> predicted weight.
+    """
+    predictions = predict_module_weights(test_modules, weights_index)
+    for module, weight in predictions.items():
+        add_to_weights_index(weights_index, module, weight)
+    if predictions:
+        print('# Predicted weights of {0} test modules with no weight'.format(len(predictions)))
+    return predictions
 
 
 def copy_plugins_to_repo_dirs():
@@ -95,70 +1165,1150 @@ def copy_plugins_to_repo_dirs():
                         os.path.expanduser('~'), plugin_name, name))
 
 
-def run_tests(repos_dir, group_number, number_of_groups, pattern, dry_run, weights_file, config):
+def record_repository_revisions(repos_dir, group_number):
+    """Write the revision checked out in each repository under `repos_dir`
+    to REVISIONS_FILE (recorded by create-report.py).
+    """
+    revisions = {}
+    for repo in sorted(os.listdir(repos_dir)):
+        repo_dir = os.path.join(repos_dir, repo)
+        if not os.path.isdir(os.path.join(repo_dir, '.git')):
+            continue
+        try:
+            with open(os.devnull, 'w') as devnull:
+                revisions[repo] = subprocess.check_output(
+                    ['git', 'rev-parse', 'HEAD'], cwd=repo_dir, stderr=devnull).decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError):
+            print('# Could not get the revision of {0}, skipping it'.format(repo))
+    revisions_file = os.path.expanduser(REVISIONS_FILE.format(group_number))
+    with open(revisions_file, 'w') as f:
+        f.write(json.dumps(revisions, indent=2, sort_keys=True))
+
+
+def get_run_queue_file(queue_file, run_id):
+    """Return the file based queue of the `run_id` run, so a queue (and its
+    failures count) left by a previous run is not reused.
+    """
+    name, extension = os.path.splitext(queue_file)
+    return '{0}-{1}{2}'.format(name, run_id, extension)
+
+
+def pop_module_from_queue_file(queue_file, test_modules):
+    """Pop the next module to run from a JSON file based queue (see
+    `get_run_queue_file`).
+
+    Access to the queue is serialized using an exclusive lock on a
+    `<queue_file>.lock` file. The first caller initializes the queue with
+    `test_modules`. Returns None when the queue is empty.
+    """
+    import fcntl
+    with open('{0}.lock'.format(queue_file), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if os.path.exists(queue_file):
+                with open(queue_file, 'r') as f:
+                    test_modules = json.loads(f.read())
+            module = test_modules.pop(0) if test_modules else None
+            with open(queue_file, 'w') as f:
+                f.write(json.dumps(test_modules, indent=2))
+            return module
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def pop_module_from_queue_server(queue_url):
+    """Pop the next module to run from a queue server (see `serve_queue`).
+
+    The queue server may not be up yet (it is started by one of the test
+    servers), so connection errors are retried for QUEUE_CONNECT_TIMEOUT
+    seconds. Returns None when the queue is empty.
+    """
+    deadline = time.time() + QUEUE_CONNECT_TIMEOUT
+    while True:
+        try:
+            response = urlopen('{0}/next'.format(queue_url.rstrip('/')))
+            if response.getcode() == 204:
+                return None
+            return response.read().decode('utf-8')
+        except URLError as e:
+            if time.time() > deadline:
+                raise
+            print('# Queue server is not available ({0}), retrying in {1} seconds..'.format(
+                e, QUEUE_CONNECT_INTERVAL))
+            time.sleep(QUEUE_CONNECT_INTERVAL)
+
+
+def update_queue_file_failures(queue_file, increment):
+    """Add `increment` to the failed runs count of a file based queue (kept
+    in a `<queue_file>.failures` file), and return the updated count.
+    """
+    import fcntl
+    failures_file = '{0}.failures'.format(queue_file)
+    with open('{0}.lock'.format(queue_file), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            failures = 0
+            if os.path.exists(failures_file):
+                with open(failures_file, 'r') as f:
+                    failures = int(f.read() or 0)
+            if increment:
+                failures += increment
+                with open(failures_file, 'w') as f:
+                    f.write(str(failures))
+            return failures
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def update_queue_failures(queue_file, queue_url, increment=0):
+    """Add `increment` to the failed runs count shared by all the servers
+    pulling from a queue (or sharing a queue server for their failures, see
+    `--failures-url`), and return the updated count.
+
+    Connection errors are retried for QUEUE_CONNECT_TIMEOUT seconds, as the
+    queue server may not be up yet.
+    """
+    if not queue_url:
+        return update_queue_file_failures(queue_file, increment)
+    url = '{0}/failures'.format(queue_url.rstrip('/'))
+    deadline = time.time() + QUEUE_CONNECT_TIMEOUT
+    while True:
+        try:
+            response = urlopen(url, data=b'1') if increment else urlopen(url)
+            return int(response.read().decode('utf-8'))
+        except URLError as e:
+            if time.time() > deadline:
+                raise
+            print('# Queue server is not available ({0}), retrying in {1} seconds..'.format(
+                e, QUEUE_CONNECT_INTERVAL))
+            time.sleep(QUEUE_CONNECT_INTERVAL)
+
+
+class QueueRequestHandler(BaseHTTPRequestHandler):
+
+    test_modules = []
+    failures = 0
+    # The calibration benchmark timings (see `calibrate_server`) per server,
+    # and the number of servers to calibrate.
+    calibration = {}
+    calibration_groups = None
+    calibration_deadline = None
+    # Once decided, the speed factors of all servers (or None, if not all of
+    # them were calibrated in time) are the same for every server asking.
+    calibration_decided = False
+    speed_factors = None
+
+    @classmethod
+    def decide_calibration(cls):
+        if cls.calibration_decided or cls.calibration_groups is None:
+            return
+        if len(cls.calibration) >= cls.calibration_groups:
+            cls.speed_factors = get_speed_factors(
+                [cls.calibration[str(i + 1)] for i in range(cls.calibration_groups)])
+            cls.calibration_decided = True
+        elif time.time() > cls.calibration_deadline:
+            print('# Not all servers were calibrated, splitting without speed factors')
+            cls.calibration_decided = True
+
+    def send_text(self, text):
+        content = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        if self.path == '/failures':
+            self.send_text(str(QueueRequestHandler.failures))
+            return
+        if self.path == '/calibration':
+            QueueRequestHandler.decide_calibration()
+            self.send_text(json.dumps({'decided': QueueRequestHandler.calibration_decided,
+                                       'speed_factors': QueueRequestHandler.speed_factors}))
+            return
+        if self.path != '/next':
+            self.send_error(404)
+            return
+        if not self.test_modules:
+            self.send_response(204)
+            self.end_headers()
+            return
+        self.send_text(self.test_modules.pop(0))
+
+    def do_POST(self):
+        content = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.startswith('/calibration/'):
+            calibration = json.loads(content.decode('utf-8'))
+            if QueueRequestHandler.calibration_deadline is None:
+                QueueRequestHandler.calibration_deadline = time.time() + QUEUE_CONNECT_TIMEOUT
+            QueueRequestHandler.calibration_groups = calibration['number_of_groups']
+            QueueRequestHandler.calibration[self.path.split('/')[-1]] = calibration['timings']
+            QueueRequestHandler.decide_calibration()
+            self.send_text(json.dumps(QueueRequestHandler.calibration))
+            return
+        if self.path != '/failures':
+            self.send_error(404)
+            return
+        QueueRequestHandler.failures += 1
+        self.send_text(str(QueueRequestHandler.failures))
+
+
+def serve_queue(repos_dir, pattern, weights_file, weights_statistic, config, port, discovery_cache_file,
+                impact_map_file=None, changed_since=DEFAULT_CHANGED_SINCE, failures_first=False, from_report=None,
+                predict_weights=True, narrow_impact=False):
+    """Serve test modules to pull from, heaviest first (or most likely to
+    fail first), over HTTP.
+
+    Test servers get the next module by calling `GET /next` until an empty
+    (204) response is returned. Failed runs are counted by calling
+    `POST /failures`, and the count is returned by `GET /failures`.
+    The calibration timings of each server are shared by calling
+    `POST /calibration/<group_number>`, and the speed factors of all the
+    servers are returned by `GET /calibration` (see `calibrate_server`).
+    """
+    test_modules_weights = get_test_modules_weights(weights_file, weights_statistic)
+    test_modules = get_test_modules(config, pattern, repos_dir, discovery_cache_file)
+    if predict_weights:
+        add_predicted_weights(test_modules, test_modules_weights)
+    if impact_map_file:
+        test_modules = select_impacted_modules(test_modules, repos_dir, config, impact_map_file, changed_since,
+                                               narrow_impact)
+    if from_report:
+        test_modules = select_failed_tests(test_modules, from_report)
+    QueueRequestHandler.test_modules = [
+        m for m, _ in sort_modules_by_weight(test_modules, test_modules_weights)]
+    if failures_first:
+        QueueRequestHandler.test_modules = [x for x, in order_by_failure_probability(
+            [[m] for m in QueueRequestHandler.test_modules], test_modules_weights,
+            get_test_modules_failure_rates(weights_file))]
+    print('# Serving {0} test modules on port {1}'.format(len(test_modules), port))
+    HTTPServer(('', port), QueueRequestHandler).serve_forever()
+
+
+def iter_queue_modules(test_modules, weights_index, queue_file, queue_url, failures_index=None):
+    """Yield modules pulled from a shared queue until it is empty."""
+    ordered_modules = [m for m, _ in sort_modules_by_weight(test_modules, weights_index)]
+    if failures_index is not None:
+        ordered_modules = [x for x, in order_by_failure_probability(
+            [[m] for m in ordered_modules], weights_index, failures_index)]
+    while True:
+        if queue_url:
+            module = pop_module_from_queue_server(queue_url)
+        else:
+            module = pop_module_from_queue_file(queue_file, ordered_modules)
+        if module is None:
+            return
+        yield module
+
+
+def run_calibration_benchmark(benchmark_file):
+    """Run a short benchmark of the server's CPU, disk (writing
+    `benchmark_file`) and docker containers startup, and return the timing
+    (in seconds) of each.
+
+    The docker image is pulled beforehand, so the docker timing only measures
+    starting a container. It is left out if a container cannot be started.
+    """
+    timings = {}
+    data = b'x' * 1024 * 1024
+
+    start = time.time()
+    digest = hashlib.sha1()
+    for _ in range(CALIBRATION_CPU_MEGABYTES):
+        digest.update(data)
+    timings['cpu'] = time.time() - start
+
+    start = time.time()
+    with open(benchmark_file, 'wb') as f:
+        for _ in range(CALIBRATION_DISK_MEGABYTES):
+            f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    timings['disk'] = time.time() - start
+    os.remove(benchmark_file)
+
+    try:
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['docker', 'pull', CALIBRATION_IMAGE], stdout=devnull, stderr=subprocess.STDOUT)
+            start = time.time()
+            exit_code = subprocess.call(['docker', 'run', '--rm', CALIBRATION_IMAGE, 'true'],
+                                        stdout=devnull, stderr=subprocess.STDOUT)
+    except OSError:
+        exit_code = -1
+    if exit_code == 0:
+        timings['docker'] = time.time() - start
+    return timings
+
+
+def get_speed_factors(servers_timings):
+    """Return the speed factor of each server (e.g. 1.3 for a server running
+    30% slower than the others), given the calibration benchmark timings of
+    all of them (see `run_calibration_benchmark`).
+
+    The factor of a server is the geometric mean of its timings relative to
+    the geometric mean of all the servers' timings, so it does not depend on
+    the scale of each timing. Timings missing on any of the servers (e.g.
+    docker failed) are left out on all of them.
+    """
+    keys = set.intersection(*[set(x) for x in servers_timings]) if servers_timings else set()
+    if not keys:
+        return [1.0] * len(servers_timings)
+    logs = [dict((k, math.log(max(x[k], 0.001))) for k in keys) for x in servers_timings]
+    reference = dict((k, sum(x[k] for x in logs) / len(logs)) for k in keys)
+    return [math.exp(sum(x[k] - reference[k] for k in keys) / len(keys)) for x in logs]
+
+
+def read_speed_factors(speed_factors_file):
+    """Read the speed factors recorded by previous runs (see
+    `./itests.py run --calibrate`).
+    """
+    with open(speed_factors_file, 'r') as f:
+        return json.loads(f.read())
+
+
+def get_pool_speed_factors(recorded_factors, number_of_servers):
+    """Return the speed factors of `number_of_servers` servers mixed like the
+    servers `recorded_factors` were measured on (evenly spread over their
+    distribution).
+
+    Weights are measured on servers of the same pool, so the factors are
+    relative to the mean recorded factor.
+    """
+    recorded_factors = sorted(recorded_factors)
+    mean = float(sum(recorded_factors)) / len(recorded_factors)
+    return [recorded_factors[(2 * i + 1) * len(recorded_factors) // (2 * number_of_servers)] / mean
+            for i in range(number_of_servers)]
+
+
+def calibrate_server(group_number, number_of_groups, calibration_url=None):
+    """Run the calibration benchmark, and write its timings to
+    CALIBRATION_FILE.
+
+    When `calibration_url` (a queue server, see `serve_queue`) is given, the
+    timings are shared with the other servers, and the speed factors of all
+    `number_of_groups` servers (see `get_speed_factors`) are returned once all
+    of them are calibrated (the server's factor is written to CALIBRATION_FILE
+    as well). Returns None otherwise, or when the queue server decided the
+    servers were not all calibrated within QUEUE_CONNECT_TIMEOUT seconds (the
+    decision is the same for all servers, so they all split the tests the same
+    way).
+    """
+    calibration_file = os.path.expanduser(CALIBRATION_FILE.format(group_number))
+    timings = run_calibration_benchmark('{0}.tmp'.format(calibration_file))
+    print('# Calibration timings: {0}'.format(json.dumps(timings, sort_keys=True)))
+    speed_factors = share_calibration(timings, group_number, number_of_groups, calibration_url) \
+        if calibration_url else None
+    with open(calibration_file, 'w') as f:
+        f.write(json.dumps({'server': group_number, 'host': socket.gethostname(), 'timings': timings,
+                            'speed_factor': speed_factors[group_number - 1] if speed_factors else None}, indent=2))
+    return speed_factors
+
+
+def share_calibration(timings, group_number, number_of_groups, calibration_url):
+    """Share the calibration `timings` of the server with the queue server
+    at `calibration_url`, and return the speed factors of all the servers
+    once it decided them (see `calibrate_server`).
+    """
+    url = '{0}/calibration'.format(calibration_url.rstrip('/'))
+    deadline = time.time() + QUEUE_CONNECT_TIMEOUT
+    shared = False
+    while True:
+        try:
+            if not shared:
+                urlopen('{0}/{1}'.format(url, group_number), data=json.dumps({
+                    'timings': timings, 'number_of_groups': number_of_groups}).encode('utf-8'))
+                shared = True
+            calibration = json.loads(urlopen(url).read().decode('utf-8'))
+            if calibration['decided']:
+                if calibration['speed_factors'] is None:
+                    print('# Not all servers were calibrated, splitting without speed factors')
+                return calibration['speed_factors']
+            deadline = time.time() + QUEUE_CONNECT_TIMEOUT
+        except URLError as e:
+            print('# Queue server is not available ({0})'.format(e))
+            if time.time() > deadline:
+                print('# Queue server is not available, splitting without speed factors')
+                return None
+        print('# Waiting for the other servers calibration, retrying in {0} seconds..'.format(QUEUE_CONNECT_INTERVAL))
+        time.sleep(QUEUE_CONNECT_INTERVAL)
+
+
+def create_slot_network(slot):
+    """Create a docker network with a dedicated address range for `slot`.
+
+    Returns the environment variables exposing the slot and its network to
+    the tests running in it. Only managers restored by `ManagerSnapshot` are
+    attached to it, the tests framework does not consume them yet.
+    """
+    network_name = SLOT_NETWORK_NAME.format(slot)
+    subnet = SLOT_NETWORK_SUBNET.format(slot)
+    if os.system('docker network inspect {0} > /dev/null 2>&1 || docker network create --subnet {1} {0}'.format(
+            network_name, subnet)) != 0:
+        print('# Failed creating docker network {0} for slot {1}'.format(network_name, slot))
+    return {
+        'ITESTS_SLOT': slot,
+        'ITESTS_DOCKER_NETWORK': network_name,
+        'ITESTS_DOCKER_SUBNET': subnet
+    }
+
+
+def remove_slot_network(slot):
+    """Remove the docker network of `slot` (see `create_slot_network`)."""
+    network_name = SLOT_NETWORK_NAME.format(slot)
+    if os.system('docker network rm {0} > /dev/null 2>&1'.format(network_name)) != 0:
+        print('# Failed removing docker network {0} of slot {1}'.format(network_name, slot))
+
+
+class EventsLog(object):
+    """Appends events of the server's progress, as JSON lines, to a file which
+    can be tailed during the run (see `./itests.py events`).
+
+    Each event is a JSON object with "event", "server", "host" and "time"
+    (epoch seconds) fields, along with the fields of the specific event:
+    server_started, scheduled, started, finished, aborted and server_finished.
+    """
+
+    def __init__(self, events_file, server):
+        self.events_file = events_file and os.path.expanduser(events_file)
+        self.server = server
+        self.host = socket.gethostname()
+        self.lock = threading.Lock()
+
+    def emit(self, event, **fields):
+        if not self.events_file:
+            return
+        fields.update({'event': event, 'server': self.server, 'host': self.host, 'time': time.time()})
+        line = json.dumps(fields, sort_keys=True)
+        with self.lock:
+            with open(self.events_file, 'a') as f:
+                f.write(line + '\n')
+
+
+def iter_scheduled_runs(test_runs, weights_index, events):
+    """Yield `test_runs`, emitting a scheduled event for each one."""
+    for i, test_items in enumerate(test_runs):
+        events.emit('scheduled', run=i, modules=test_items,
+                    weight=sum(get_module_weight(weights_index, x) for x in test_items))
+        yield test_items
+
+
+class ManagerSnapshot(object):
+    """Snapshots a freshly bootstrapped manager container once per server,
+    and restores it before each test module instead of bootstrapping a new
+    manager.
+
+    The restored container is exposed to the tests by the
+    ITESTS_MANAGER_CONTAINER and ITESTS_MANAGER_IP environment variables, a
+    module is run without them if the restore fails. The tests framework does
+    not consume them yet, so the tests still bootstrap their own manager.
+    """
+
+    def __init__(self):
+        self.created = False
+        # The bind mounts of the bootstrapped container, which `docker commit`
+        # does not keep.
+        self.binds = []
+
+    def create(self):
+        """Bootstrap a manager and commit its container to an image."""
+        print('# Bootstrapping a manager for the manager snapshot')
+        try:
+            existing = set(subprocess.check_output(['docker', 'ps', '-aq']).decode('utf-8').split())
+            subprocess.check_call(MANAGER_BOOTSTRAP_COMMAND, shell=True)
+            containers = [x for x in subprocess.check_output(['docker', 'ps', '-aq']).decode('utf-8').split()
+                          if x not in existing]
+            if len(containers) != 1:
+                raise OSError('expected a single bootstrapped container, found {0}'.format(len(containers)))
+            container = containers[0]
+            self.binds = json.loads(subprocess.check_output(
+                ['docker', 'inspect', '-f', '{{json .HostConfig.Binds}}', container]).decode('utf-8')) or []
+            subprocess.check_call(['docker', 'commit', container, MANAGER_SNAPSHOT_IMAGE])
+            subprocess.check_call(['docker', 'rm', '-f', container])
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            print('# Failed creating the manager snapshot, modules will bootstrap their manager: {0}'.format(e))
+            return False
+        self.created = True
+        return True
+
+    def restore(self, slot, env=None):
+        """Start a manager container of `slot` from the snapshot (replacing
+        the slot's previous one), and return the environment variables
+        exposing it, or an empty dict if the restore failed.
+        """
+        if not self.created:
+            return {}
+        name = MANAGER_CONTAINER_NAME.format(slot)
+        command = ['docker', 'run', '-d', '--privileged', '--name', name]
+        for bind in self.binds:
+            command.extend(['-v', bind])
+        if env and env.get('ITESTS_DOCKER_NETWORK'):
+            command.extend(['--network', env['ITESTS_DOCKER_NETWORK']])
+        try:
+            self.remove(slot)
+            subprocess.check_call(command + [MANAGER_SNAPSHOT_IMAGE])
+            ip_address = subprocess.check_output([
+                'docker', 'inspect', '-f', '{{range .NetworkSettings.Networks}}{{.IPAddress}}{{end}}', name
+            ]).decode('utf-8').strip()
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('# Failed restoring the manager snapshot, bootstrapping instead: {0}'.format(e))
+            return {}
+        deadline = time.time() + MANAGER_READY_TIMEOUT
+        while time.time() < deadline:
+            try:
+                urlopen(MANAGER_STATUS_URL.format(ip_address), timeout=10)
+            except HTTPError:
+                # Any response (e.g. 401 without credentials) means it is up.
+                pass
+            except (URLError, IOError):
+                time.sleep(5)
+                continue
+            return {'ITESTS_MANAGER_CONTAINER': name, 'ITESTS_MANAGER_IP': ip_address}
+        print('# Restored manager {0} is not responding, bootstrapping instead'.format(name))
+        self.remove(slot)
+        return {}
+
+    def remove(self, slot):
+        """Remove the manager container of `slot`, if any."""
+        with open(os.devnull, 'w') as devnull:
+            subprocess.call(['docker', 'rm', '-f', MANAGER_CONTAINER_NAME.format(slot)],
+                            stdout=devnull, stderr=subprocess.STDOUT)
+
+
+def get_pytest_rootdir(module_name):
+    """Return the rootdir of a pytest run of `module_name`, found the way
+    pytest finds it: the first ancestor of the module with an ini file, else
+    with a setup.py, else the module's directory.
+    """
+    module_dir = os.path.dirname(os.path.abspath(module_name))
+    ancestors = [module_dir]
+    while os.path.dirname(ancestors[-1]) != ancestors[-1]:
+        ancestors.append(os.path.dirname(ancestors[-1]))
+    for directory in ancestors:
+        for name, section in PYTEST_INI_FILES:
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                with open(path, 'r') as f:
+                    if section is None or section in f.read():
+                        return directory
+    for directory in ancestors:
+        if os.path.isfile(os.path.join(directory, 'setup.py')):
+            return directory
+    return module_dir
+
+
+def get_junit_classname(module_name, class_names, group_number):
+    """Return the junit classname of a test in `module_name`, in the same
+    format pytest uses with `--junit-prefix="Server-<group_number>"` (the
+    module path is relative to the pytest rootdir, as in node ids).
+    """
+    module_path = os.path.splitext(get_relative_path(os.path.abspath(module_name),
+                                                     get_pytest_rootdir(module_name)))[0]
+    return '.'.join(['Server-{0}'.format(group_number), module_path.replace('/', '.')] + list(class_names))
+
+
+def write_time_budget_report(skipped_modules, group_number):
+    """Write a junit report listing `skipped_modules` as skipped for the
+    time budget (see `select_modules_within_budget`), each as a skipped
+    test of a `TimeBudget` test class.
+    """
+    suite = ElementTree.Element('testsuite', {
+        'name': 'pytest', 'tests': str(len(skipped_modules)), 'errors': '0', 'failures': '0',
+        'skip': str(len(skipped_modules)), 'time': '0'})
+    for module in skipped_modules:
+        testcase = ElementTree.SubElement(suite, 'testcase', {
+            'classname': get_junit_classname(module.partition(TEST_ID_SEPARATOR)[0], [TIME_BUDGET_TEST_CLASS],
+                                             group_number),
+            'name': module.partition(TEST_ID_SEPARATOR)[2] or 'skipped',
+            'time': '0'
+        })
+        ElementTree.SubElement(testcase, 'skipped', {'message': 'skipped for the time budget'})
+    ElementTree.ElementTree(suite).write(
+        os.path.expanduser('~/report-{0}-budget.xml'.format(group_number)), encoding='utf-8')
+
+
+class HangWatchdog(object):
+    """Supervises pytest runs, killing runs taking over `timeout_factor` times
+    their historical 95th percentile duration (and at least `min_timeout`
+    seconds), so a hung module does not block the rest of its group.
+
+    Before a hung run is killed, the Python stacks of its pytest process and
+    the logs of the running docker containers are dumped to
+    `$HOME/hang-<group>-<index>.txt`, and the run is recorded as timed out in
+    its junit report.
+    """
+
+    def __init__(self, weights_index, durations_index, timeout_factor=HANG_TIMEOUT_FACTOR,
+                 min_timeout=MIN_HANG_TIMEOUT):
+        self.weights_index = weights_index
+        self.durations_index = durations_index
+        self.timeout_factor = timeout_factor
+        self.min_timeout = min_timeout
+
+    def get_timeout(self, test_items):
+        expected_duration = 0
+        for item in test_items:
+            durations = get_module_history(self.durations_index, item)
+            expected_duration += get_percentile(durations, 95) if durations \
+                else get_module_weight(self.weights_index, item)
+        return max(self.timeout_factor * expected_duration, self.min_timeout)
+
+    def run(self, command, test_items, group_number, index):
+        """Run `command` (a pytest run of `test_items`), return its exit code."""
+        timeout = self.get_timeout(test_items)
+        # faulthandler dumps the Python stacks of the pytest process to its
+        # stderr once it is aborted.
+        process = subprocess.Popen(command, shell=True, env=dict(os.environ, PYTHONFAULTHANDLER='1'))
+        timed_out = threading.Event()
+        timer = threading.Timer(timeout, self.kill, args=(process, group_number, index, timeout, timed_out))
+        timer.start()
+        try:
+            exit_code = process.wait()
+        finally:
+            timer.cancel()
+        if timed_out.is_set():
+            self.write_timeout_report(test_items, group_number, index, timeout)
+        return exit_code
+
+    def kill(self, process, group_number, index, timeout, timed_out):
+        if process.poll() is not None:
+            return
+        timed_out.set()
+        print('# Run {0} timed out after {1:.0f} seconds, killing it'.format(index, timeout))
+        with open(os.path.expanduser('~/hang-{0}-{1}.txt'.format(group_number, index)), 'w') as f:
+            f.write('# Timed out after {0:.0f} seconds\n# Python stacks:\n'.format(timeout))
+            f.flush()
+            subprocess.call('command -v py-spy > /dev/null && py-spy dump --pid {0} || '
+                            'echo "py-spy is not installed"'.format(process.pid),
+                            shell=True, stdout=f, stderr=subprocess.STDOUT)
+            for container in subprocess.check_output('docker ps -q 2> /dev/null || true', shell=True).decode('utf-8').split():
+                f.write('\n# Logs of docker container {0}:\n'.format(container))
+                f.flush()
+                subprocess.call('docker logs --tail {0} {1}'.format(HANG_CONTAINER_LOG_LINES, container),
+                                shell=True, stdout=f, stderr=subprocess.STDOUT)
+        process.send_signal(signal.SIGABRT)
+        deadline = time.time() + HANG_KILL_GRACE_PERIOD
+        while process.poll() is None and time.time() < deadline:
+            time.sleep(1)
+        if process.poll() is None:
+            process.kill()
+
+    def write_timeout_report(self, test_items, group_number, index, timeout):
+        """Write the junit report of a timed out run, with a `timeout` error
+        per test item (modules are recorded as a `Timeout` test class).
+        """
+        dump_file = os.path.expanduser('~/hang-{0}-{1}.txt'.format(group_number, index))
+        with open(dump_file, 'r') as f:
+            dump = f.read()
+        suite = ElementTree.Element('testsuite', {
+            'name': 'pytest', 'tests': str(len(test_items)), 'errors': str(len(test_items)),
+            'failures': '0', 'skip': '0', 'time': str(timeout)})
+        for item in test_items:
+            module_name, _, test_name = item.partition(TEST_ID_SEPARATOR)
+            names = test_name.split(TEST_ID_SEPARATOR) if test_name else [TIMEOUT_TEST_CLASS, 'timeout']
+            testcase = ElementTree.SubElement(suite, 'testcase', {
+                'classname': get_junit_classname(module_name, names[:-1], group_number),
+                'name': names[-1],
+                'time': str(float(timeout) / len(test_items))
+            })
+            error = ElementTree.SubElement(testcase, 'error', {
+                'type': TIMEOUT_ERROR_TYPE, 'message': 'timed out after {0:.0f} seconds'.format(timeout)})
+            error.text = dump
+        ElementTree.ElementTree(suite).write(
+            os.path.expanduser('~/report-{0}-{1}.xml'.format(group_number, index)), encoding='utf-8')
+
+
+def run_test_module(test_items, group_number, index, env=None, watchdog=None):
+    command = 'pytest -v -s {0} --junit-xml=$HOME/report-{1}-{2}.xml --junit-prefix="Server-{1}"'.format(
+            ' '.join('"{0}"'.format(x) for x in test_items), group_number, index)
+    if env:
+        command = 'env {0} {1}'.format(' '.join('{0}={1}'.format(k, v) for k, v in sorted(env.items())), command)
+    if watchdog:
+        # exec, so signals are sent to the pytest process rather than the shell.
+        return watchdog.run('exec {0}'.format(command), test_items, group_number, index)
+    return os.system(command)
 
-    test_modules_weights = get_test_modules_weights(weights_file)
 
-    print('# Collecting tests [group_number={0}, number_of_groups={1}, pattern={2}, dry_run={3}, weights_file={4}]'.format(
-        group_number, number_of_groups, pattern, dry_run, weights_file))
+class ModuleJunitPlugin(object):
+    """A pytest plugin writing a junit report per pytest run (see
+    `group_test_items`) when running several runs in a single session.
 
-    test_modules = get_test_modules(config, pattern, repos_dir)
+    The reports are written in the same layout as running each run with
+    `pytest --junit-xml=$HOME/report-<group>-<index>.xml --junit-prefix=Server-<group>`.
+
+    When `failures_url` (a queue server) is given, failed runs are counted by
+    it, and the session stops once `max_failures` runs failed on all servers.
+    """
+
+    def __init__(self, test_runs, group_number, events, max_failures=None, failures_url=None):
+        self.group_number = group_number
+        self.events = events
+        self.max_failures = max_failures
+        self.failures_url = failures_url
+        self.session = None
+        self.rootdir = None
+        self.test_runs = test_runs
+        self.run_index = {}
+        for i, test_items in enumerate(test_runs):
+            for item in test_items:
+                self.run_index[os.path.abspath(item.partition(TEST_ID_SEPARATOR)[0])] = i
+        self.testcases = {}
+        self.current_run = None
+        self.current_run_start = None
+
+    def get_run_index(self, nodeid):
+        module_name = os.path.abspath(os.path.join(self.rootdir, nodeid.partition(TEST_ID_SEPARATOR)[0]))
+        return self.run_index.get(module_name, len(self.run_index))
+
+    def get_testcase(self, nodeid):
+        run_testcases = self.testcases.setdefault(self.get_run_index(nodeid), {})
+        if nodeid not in run_testcases:
+            # Mangled the way pytest does, so a module failing to be collected
+            # is named by its dotted module name under a `Server-<n>` class.
+            names = nodeid.split(TEST_ID_SEPARATOR)
+            names[0] = os.path.splitext(names[0])[0].replace('/', '.')
+            classnames = ['Server-{0}'.format(self.group_number)] + names[:-1]
+            run_testcases[nodeid] = ElementTree.Element('testcase', {
+                'classname': '.'.join(classnames),
+                'name': names[-1],
+                'time': '0'
+            })
+        return run_testcases[nodeid]
+
+    def add_result(self, nodeid, tag, message, text):
+        result = ElementTree.SubElement(self.get_testcase(nodeid), tag, {'message': message})
+        result.text = text
+
+    def pytest_sessionstart(self, session):
+        self.session = session
+        self.rootdir = str(session.config.rootdir)
+
+    def finish_current_run(self):
+        if self.current_run is None:
+            return
+        failed = any(x.find('error') is not None or x.find('failure') is not None
+                     for x in self.testcases.get(self.current_run, {}).values())
+        self.events.emit('finished', run=self.current_run, slot=0,
+                         modules=self.test_runs[self.current_run] if self.current_run < len(self.test_runs) else [],
+                         duration=time.time() - self.current_run_start, exit_code=int(failed))
+        self.current_run = None
+        if failed and self.failures_url:
+            update_queue_failures(None, self.failures_url, increment=1)
+
+    def pytest_runtest_logstart(self, nodeid, location):
+        run = self.get_run_index(nodeid)
+        if run == self.current_run:
+            return
+        self.finish_current_run()
+        self.current_run = run
+        self.current_run_start = time.time()
+        self.events.emit('started', run=run, slot=0,
+                         modules=self.test_runs[run] if run < len(self.test_runs) else [])
+
+    def pytest_collectreport(self, report):
+        if report.failed:
+            self.add_result(report.nodeid, 'error', 'collection failure', str(report.longrepr))
+
+    def pytest_runtest_logreport(self, report):
+        testcase = self.get_testcase(report.nodeid)
+        testcase.set('time', str(float(testcase.get('time')) + getattr(report, 'duration', 0)))
+        if report.failed:
+            if report.when == 'call':
+                self.add_result(report.nodeid, 'failure', 'test failure', str(report.longrepr))
+            else:
+                self.add_result(report.nodeid, 'error', 'test {0} failure'.format(report.when), str(report.longrepr))
+        elif report.skipped and report.when != 'teardown':
+            self.add_result(report.nodeid, 'skipped', 'skipped', str(report.longrepr))
+        for name, content in getattr(report, 'sections', []):
+            tag = 'system-err' if 'stderr' in name else 'system-out'
+            output = testcase.find(tag)
+            if output is None:
+                output = ElementTree.SubElement(testcase, tag)
+                output.text = ''
+            output.text += content
+        if report.when == 'teardown' and self.failures_url and self.max_failures:
+            failures = update_queue_failures(None, self.failures_url)
+            if failures >= self.max_failures:
+                print('# Reached {0} failed runs, not running the remaining tests'.format(failures))
+                self.events.emit('aborted', failures=failures)
+                self.session.shouldstop = 'reached {0} failed runs'.format(failures)
+
+    def pytest_sessionfinish(self, session):
+        self.finish_current_run()
+        for i, run_testcases in sorted(self.testcases.items()):
+            testcases = list(run_testcases.values())
+            suite = ElementTree.Element('testsuite', {
+                'name': 'pytest',
+                'tests': str(len(testcases)),
+                'errors': str(len([x for x in testcases if x.find('error') is not None])),
+                'failures': str(len([x for x in testcases if x.find('failure') is not None])),
+                'skip': str(len([x for x in testcases if x.find('skipped') is not None])),
+                'time': str(sum(float(x.get('time')) for x in testcases))
+            })
+            suite.extend(testcases)
+            ElementTree.ElementTree(suite).write(
+                os.path.expanduser('~/report-{0}-{1}.xml'.format(self.group_number, i)),
+                encoding='utf-8')
+
+
+def run_test_runs_in_session(test_runs, group_number, max_failures=None, events=None, failures_url=None):
+    """Run `test_runs` in a single pytest session, so the test framework is
+    imported and session fixtures are set up once, while still writing a
+    junit report per run.
+    """
+    import pytest
+    test_runs = list(test_runs)
+    args = ['-v', '-s', '--continue-on-collection-errors'] + [x for test_items in test_runs for x in test_items]
+    if max_failures and not failures_url:
+        # Failures are counted per test rather than per run in a single session.
+        args.append('--maxfail={0}'.format(max_failures))
+    events = events or EventsLog(None, group_number)
+    return pytest.main(args, plugins=[ModuleJunitPlugin(test_runs, group_number, events, max_failures, failures_url)])
+
+
+def run_test_runs(test_runs, group_number, slots, max_failures=None, queue_file=None, queue_url=None, events=None,
+                  watchdog=None, manager_snapshot=None):
+    """Run `test_runs` (see `group_test_items`) `slots` at a time.
+
+    Each slot takes the next run once its previous run is done, so runs
+    should be ordered heaviest first. No more runs are started once
+    `max_failures` runs failed (on all the servers sharing the queue, when
+    `queue_file` or `queue_url` is given). Runs are supervised by `watchdog` (see
+    `HangWatchdog`), and a manager is restored from `manager_snapshot` (see
+    `ManagerSnapshot`) before each run, if given.
+    Returns the last non zero exit code.
+    """
+    test_runs = enumerate(test_runs)
+    lock = threading.Lock()
+    exit_codes = []
+    shared_failures = queue_file or queue_url
+    events = events or EventsLog(None, group_number)
+
+    def max_failures_reached():
+        if not max_failures:
+            return False
+        if shared_failures:
+            failures = update_queue_failures(queue_file, queue_url)
+        else:
+            failures = len([x for x in exit_codes if x])
+        if failures >= max_failures:
+            print('# Reached {0} failed runs, not running the remaining tests'.format(failures))
+            events.emit('aborted', failures=failures)
+            return True
+        return False
+
+    def run_slot(slot):
+        env = create_slot_network(slot) if slots > 1 else None
+        while True:
+            with lock:
+                if max_failures_reached():
+                    return
+                try:
+                    i, test_items = next(test_runs)
+                except StopIteration:
+                    return
+            events.emit('started', run=i, slot=slot, modules=test_items)
+            start = time.time()
+            run_env = dict(env or {})
+            if manager_snapshot:
+                run_env.update(manager_snapshot.restore(slot, env))
+            exit_code = run_test_module(test_items, group_number, i, run_env, watchdog)
+            events.emit('finished', run=i, slot=slot, modules=test_items, duration=time.time() - start,
+                        exit_code=exit_code)
+            exit_codes.append(exit_code)
+            if exit_code and shared_failures:
+                update_queue_failures(queue_file, queue_url, increment=1)
+
+    if slots == 1:
+        run_slot(0)
+    else:
+        print('# Warning: the managers started by the tests are not attached to the slot docker networks, '
+              'modules running at the same time may interfere with each other')
+        threads = [threading.Thread(target=run_slot, args=(slot,)) for slot in range(slots)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    if manager_snapshot:
+        for slot in range(slots):
+            manager_snapshot.remove(slot)
+    if slots > 1:
+        for slot in range(slots):
+            remove_slot_network(slot)
+
+    return ([x for x in exit_codes if x] or [0])[-1]
+
+
+def run_tests(repos_dir, group_number, number_of_groups, pattern, dry_run, weights_file, config,
+              weights_statistic=DEFAULT_WEIGHTS_STATISTIC, refine=True, queue_file=None, queue_url=None,
+              split_modules=True, slots=1, single_session=False, discovery_cache_file=DISCOVERY_CACHE_FILE,
+              impact_map_file=None, changed_since=DEFAULT_CHANGED_SINCE, failures_first=False, max_failures=None,
+              events_file=None, from_report=None, hang_timeout_factor=HANG_TIMEOUT_FACTOR,
+              min_hang_timeout=MIN_HANG_TIMEOUT, predict_weights=True, time_budget=None, manager_snapshot=False,
+              calibrate=False, calibration_url=None, stable_tolerance=None, failures_url=None, queue_run_id=None,
+              narrow_impact=False):
+
+    test_modules_weights = get_test_modules_weights(weights_file, weights_statistic)
+
+    print('# Collecting tests [group_number={0}, number_of_groups={1}, pattern={2}, dry_run={3}, weights_file={4}, slots={5}]'.format(
+        group_number, number_of_groups, pattern, dry_run, weights_file, slots))
+
+    test_modules = get_test_modules(config, pattern, repos_dir, discovery_cache_file)
+    if predict_weights:
+        add_predicted_weights(test_modules, test_modules_weights)
+    if impact_map_file:
+        test_modules = select_impacted_modules(test_modules, repos_dir, config, impact_map_file, changed_since,
+                                               narrow_impact)
+    if from_report:
+        test_modules = select_failed_tests(test_modules, from_report)
 
     copy_plugins_to_repo_dirs()
+    if not dry_run:
+        record_repository_revisions(repos_dir, group_number)
 
-    modules_per_group, groups_weight = split_modules_to_groups(test_modules, number_of_groups, test_modules_weights)
+    speed_factors = None
+    if calibrate:
+        speed_factors = calibrate_server(group_number, number_of_groups, calibration_url)
 
-    print('# Groups weights: {0}'.format(json.dumps(groups_weight)))
+    if queue_file:
+        queue_file = get_run_queue_file(queue_file, queue_run_id)
 
-    print('# Calculated groups:\n{0}'.format(json.dumps(modules_per_group, indent=2)))
+    if queue_file or queue_url:
+        print('# Pulling test modules from queue: {0}'.format(queue_url or queue_file))
 
-    test_modules_to_run = modules_per_group[group_number - 1]
+        if dry_run:
+            os.system('pytest -v --collect-only {0}'.format(' '.join(test_modules)))
+            sys.exit(0)
 
-    print('# Running test modules in group number {0}'.format(group_number))
+        failures_index = get_test_modules_failure_rates(weights_file) if failures_first else None
+        test_runs = ([x] for x in iter_queue_modules(test_modules, test_modules_weights, queue_file, queue_url,
+                                                     failures_index))
+    else:
+        setups = config.get('setups', {})
+        if time_budget:
+            test_modules, skipped_modules = select_modules_within_budget(
+                test_modules, number_of_groups, slots, test_modules_weights,
+                get_test_modules_failure_rates(weights_file), time_budget, config.get('safety_modules', []),
+                refine, setups, speed_factors)
+            if group_number == 1 and not dry_run:
+                write_time_budget_report(skipped_modules, group_number)
 
-    if dry_run:
-        os.system('pytest -v --collect-only {0}'.format(' '.join(test_modules_to_run)))
-        sys.exit(0)
+        if split_modules:
+            test_modules = split_oversized_modules(test_modules, number_of_groups * slots, test_modules_weights)
 
-    collect_only = '--collect-only' if dry_run else ''
+        if stable_tolerance is not None:
+            modules_per_group, slots_weight = split_modules_to_servers_stable(
+                test_modules, number_of_groups, slots, test_modules_weights, stable_tolerance, refine, setups,
+                speed_factors)
+        else:
+            modules_per_group, slots_weight = split_modules_to_servers(
+                test_modules, number_of_groups, slots, test_modules_weights, refine, setups, speed_factors)
 
-    exit_code = 0
+        if speed_factors:
+            print('# Servers speed factors: {0}'.format(json.dumps([round(f, 2) for f in speed_factors])))
+        print('# Groups weights: {0}'.format(json.dumps(slots_weight)))
 
-    for i, test_module in enumerate(test_modules_to_run):
+        print('# Calculated groups:\n{0}'.format(json.dumps(modules_per_group, indent=2)))
 
-        command = 'pytest -v -s {0} "{1}" --junit-xml=$HOME/report-{2}-{3}.xml --junit-prefix="Server-{2}"'.format(
-                collect_only, test_module, group_number, i)
+        test_runs = get_group_test_runs(modules_per_group[group_number - 1], test_modules_weights, setups)
+        if failures_first:
+            test_runs = order_by_failure_probability(
+                test_runs, test_modules_weights, get_test_modules_failure_rates(weights_file))
+        test_modules_to_run = [x for run in test_runs for x in run]
 
-        last_exit_code = os.system(command)
+        print('# Running test modules in group number {0}'.format(group_number))
 
-        exit_code = last_exit_code or exit_code
+        if dry_run:
+            os.system('pytest -v --collect-only {0}'.format(' '.join('"{0}"'.format(x) for x in test_modules_to_run)))
+            sys.exit(0)
 
+    events = EventsLog(events_file, group_number)
+    events.emit('server_started', slots=slots, single_session=single_session,
+                dispatch='queue' if queue_file or queue_url else 'static')
+    start = time.time()
+    test_runs = iter_scheduled_runs(test_runs, test_modules_weights, events)
+
+    if single_session:
+        exit_code = run_test_runs_in_session(test_runs, group_number, max_failures, events, failures_url)
+    else:
+        if not (queue_file or queue_url):
+            test_runs = list(test_runs)
+        watchdog = None
+        if hang_timeout_factor:
+            watchdog = HangWatchdog(test_modules_weights, get_test_modules_durations(weights_file),
+                                    hang_timeout_factor, min_hang_timeout)
+        snapshot = None
+        if manager_snapshot:
+            snapshot = ManagerSnapshot()
+            if not snapshot.create():
+                snapshot = None
+        # The failed runs are counted by the queue server in static mode too,
+        # when given, so all the servers stop once max_failures is reached.
+        exit_code = run_test_runs(test_runs, group_number, slots, max_failures, queue_file,
+                                  queue_url or failures_url, events, watchdog, snapshot)
+
+    events.emit('server_finished', duration=time.time() - start, exit_code=exit_code)
     return exit_code
 
 
-def simulate(repos_dir, pattern, weights_file, config):
-    test_modules_weights = get_test_modules_weights(weights_file)
-    test_modules = get_test_modules(config, pattern, repos_dir)
+def simulate_makespans(modules_per_slot, weights_index, durations_index, trials, setups=None, speed_factors=None):
+    """Run `trials` Monte Carlo trials of running `modules_per_slot`.
+
+    In each trial, the duration of each module is drawn from its durations in
+    previous runs (modules with no history always take their weight).
+    When `setups` are configured, their cost is taken out of the drawn
+    durations and paid once per slot instead. When `speed_factors` (of each
+    slot) are given, the durations of each slot are scaled by its factor.
+    Returns the makespan of each trial.
+    """
+    setups = setups or {}
+    speed_factors = speed_factors or [1] * len(modules_per_slot)
+    rng = random.Random(SIMULATION_SEED)
+    slots_durations = []
+    slots_setup_cost = []
+    for modules in modules_per_slot:
+        slot_durations = []
+        for m in modules:
+            setup_cost = get_module_weight(weights_index, m) - get_module_test_time(weights_index, m, setups)
+            durations = get_module_history(durations_index, m) or [get_module_weight(weights_index, m)]
+            slot_durations.append([max(d - setup_cost, 0) for d in durations])
+        slots_durations.append(slot_durations)
+        slots_setup_cost.append(get_group_weight(modules, weights_index, setups) -
+                                sum(get_module_test_time(weights_index, m, setups) for m in modules))
+    makespans = []
+    for _ in range(trials):
+        makespans.append(max((setup_cost + sum(rng.choice(d) for d in slot_durations)) * factor
+                             for slot_durations, setup_cost, factor in zip(slots_durations, slots_setup_cost,
+                                                                           speed_factors)))
+    return makespans
+
+
+def simulate(repos_dir, pattern, weights_file, weights_statistic, config, refine, split_modules, slots,
+             max_servers=DEFAULT_MAX_SERVERS, trials=0, target_time=None, discovery_cache_file=DISCOVERY_CACHE_FILE,
+             impact_map_file=None, changed_since=DEFAULT_CHANGED_SINCE, from_report=None, predict_weights=True,
+             speed_factors_file=None, stable_tolerance=None, narrow_impact=False):
+    test_modules_weights = get_test_modules_weights(weights_file, weights_statistic)
+    test_modules_durations = get_test_modules_durations(weights_file)
+    test_modules = get_test_modules(config, pattern, repos_dir, discovery_cache_file)
+    predicted_weights = add_predicted_weights(test_modules, test_modules_weights) if predict_weights else {}
+    if impact_map_file:
+        test_modules = select_impacted_modules(test_modules, repos_dir, config, impact_map_file, changed_since,
+                                               narrow_impact)
+    if from_report:
+        test_modules = select_failed_tests(test_modules, from_report)
 
+    setups = config.get('setups', {})
+    recorded_factors = read_speed_factors(speed_factors_file) if speed_factors_file else []
+
+    if recorded_factors:
+        print('Modeling a mixed pool of servers (speed factors {0:.2f}-{1:.2f}, {2} calibrated servers)'.format(
+            min(recorded_factors), max(recorded_factors), len(recorded_factors)))
     print('-' * 126)
-    print('Servers   Time    Seconds   Per Server')
+    if trials:
+        print('Servers   Time    Seconds     Bound  Waste      Mean       P95   Per Server')
+    else:
+        print('Servers   Time    Seconds     Bound  Waste   Per Server')
     print('-' * 126)
 
-    for number_of_groups in range(10):
-        modules_per_group, groups_weight = split_modules_to_groups(test_modules, number_of_groups + 1, test_modules_weights)
+    recommended = None
+
+    for number_of_groups in range(max_servers):
+        number_of_slots = (number_of_groups + 1) * slots
+        test_items = test_modules
+        if split_modules:
+            test_items = split_oversized_modules(test_modules, number_of_slots, test_modules_weights,
+                                                 collect_tests=False)
+        speed_factors = get_pool_speed_factors(recorded_factors, number_of_groups + 1) if recorded_factors else None
+        slot_factors = [f for f in speed_factors for _ in range(slots)] if speed_factors else None
+        if stable_tolerance is not None:
+            modules_per_group, slot_weight = split_modules_to_servers_stable(
+                test_items, number_of_groups + 1, slots, test_modules_weights, stable_tolerance, refine, setups,
+                speed_factors)
+        else:
+            modules_per_group, slot_weight = split_modules_to_servers(
+                test_items, number_of_groups + 1, slots, test_modules_weights, refine, setups, speed_factors)
+        groups_weight = [max(slot_weight[i:i + slots]) for i in range(0, number_of_slots, slots)]
         max_time_in_seconds = max(groups_weight)
         max_time = str(datetime.timedelta(seconds=max_time_in_seconds)).split('.')[0]
-        print(' {0:3}    {1}   {2:7.2f}   {3}'.format(number_of_groups + 1, max_time, max_time_in_seconds, ', '.join(['{0:8.2f}'.format(x) for x in groups_weight])))
+        lower_bound = get_makespan_lower_bound(test_items, number_of_slots, test_modules_weights, setups,
+                                               slot_factors)
+        # Idle slots time caused by waiting for the heaviest slot.
+        waste = 100.0 * (1 - float(sum(slot_weight)) / (max_time_in_seconds * number_of_slots)) if max_time_in_seconds else 0
+        estimated_time = max_time_in_seconds
+        stochastic_columns = ''
+        if trials:
+            makespans = simulate_makespans(
+                [modules for group_slots in modules_per_group for modules in group_slots],
+                test_modules_weights, test_modules_durations, trials, setups, slot_factors)
+            estimated_time = get_percentile(makespans, 95)
+            stochastic_columns = '{0:8.2f}  {1:8.2f}   '.format(float(sum(makespans)) / trials, estimated_time)
+        print(' {0:3}    {1}   {2:7.2f}   {3:7.2f}  {4:4.1f}%  {5}{6}'.format(
+            number_of_groups + 1, max_time, max_time_in_seconds, lower_bound, waste, stochastic_columns,
+            ', '.join(['{0:8.2f}'.format(x) for x in groups_weight])))
+        if recommended is None and target_time and estimated_time <= target_time:
+            recommended = number_of_groups + 1
+
+    if predicted_weights:
+        print('')
+        print('Predicted weights (no durations history):')
+        for module, weight in sorted(predicted_weights.items()):
+            print(' * {0}: {1:.2f}'.format(module, weight))
+
+    if target_time:
+        print('')
+        if recommended:
+            print('Recommended number of servers for a {0} target time: {1}'.format(
+                datetime.timedelta(seconds=target_time), recommended))
+        else:
+            print('No number of servers up to {0} meets the {1} target time.'.format(
+                max_servers, datetime.timedelta(seconds=target_time)))
 
 
 def validate_args(args):
-    if not args.simulate:
-        if args.number_of_groups <= 0:
-            print('number_of_groups should be > 0')
-            sys.exit(1)
-        if args.group_number > args.number_of_groups or args.group_number < 1:
-            print('group_number should be between 1 to {0}'.format(args.number_of_groups))
-            sys.exit(1)
+    if args.slots < 1:
+        print('slots should be >= 1')
+        sys.exit(1)
+    if args.simulate or args.serve_queue or args.record_impact_map:
+        return
+    if args.group_number < 1:
+        print('group_number should be >= 1')
+        sys.exit(1)
+    if args.time_budget and (args.queue_file or args.queue_url):
+        print('time_budget cannot be used with a queue')
+        sys.exit(1)
+    if args.stable_assignment and (args.queue_file or args.queue_url):
+        print('stable_assignment cannot be used with a queue')
+        sys.exit(1)
+    if args.calibration_url and not args.calibrate:
+        print('calibration_url can only be used with calibrate')
+        sys.exit(1)
+    if args.calibration_url and args.number_of_groups <= 0:
+        print('calibration_url requires number_of_groups')
+        sys.exit(1)
+    if args.single_session and args.manager_snapshot:
+        print('manager_snapshot cannot be used with single_session')
+        sys.exit(1)
+    if args.failures_url and not args.max_failures:
+        print('failures_url can only be used with max_failures')
+        sys.exit(1)
+    if bool(args.queue_file) != bool(args.queue_run_id):
+        print('queue_file and queue_run_id should be used together')
+        sys.exit(1)
+    if args.failures_url and (args.queue_file or args.queue_url):
+        print('failures_url cannot be used with a queue')
+        sys.exit(1)
+    if args.single_session and (args.slots > 1 or args.queue_file or args.queue_url):
+        print('single_session cannot be used with slots or a queue')
+        sys.exit(1)
+    if args.queue_file or args.queue_url:
+        return
+    if args.number_of_groups <= 0:
+        print('number_of_groups should be > 0')
+        sys.exit(1)
+    if args.group_number > args.number_of_groups:
+        print('group_number should be between 1 to {0}'.format(args.number_of_groups))
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -174,19 +2324,151 @@ if __name__ == '__main__':
     parser.add_argument('--dry-run', action='store_true',
                         help='If specified, tests will not actually run.')
     parser.add_argument('--weights-file', type=str, required=False,
-                        help='A JSON file containing test modules weights used for optimization.')
+                        help='A JSON file containing test modules weights used for optimization, or a '
+                             'durations history file (*.jsonl) created by create-report.py.')
+    parser.add_argument('--weights-statistic', choices=WEIGHTS_STATISTICS, default=DEFAULT_WEIGHTS_STATISTIC,
+                        help='The statistic of the durations used as weights when a durations history '
+                             'file is used (default={0}).'.format(DEFAULT_WEIGHTS_STATISTIC))
     parser.add_argument('--simulate', action='store_true',
                         help='Simulate and estimate running times for different number of groups.')
+    parser.add_argument('--max-servers', type=int, required=False, default=DEFAULT_MAX_SERVERS,
+                        help='The maximum number of servers to simulate (default={0}).'.format(DEFAULT_MAX_SERVERS))
+    parser.add_argument('--trials', type=int, required=False, default=0,
+                        help='The number of Monte Carlo trials to simulate, drawing durations from the '
+                             'durations history (default=0, using the weights only).')
+    parser.add_argument('--target-time', type=int, required=False,
+                        help='Recommend the smallest number of servers running the tests within this number '
+                             'of seconds (95th percentile when simulating trials).')
+    parser.add_argument('--discovery-cache-file', type=str, required=False, default=DISCOVERY_CACHE_FILE,
+                        help='A file to cache the found test modules in (default={0}). '
+                             'Pass an empty string to disable caching.'.format(DISCOVERY_CACHE_FILE))
+    parser.add_argument('--impact-map', type=str, required=False,
+                        help='Only run the test modules affected by the changes made in the repositories since '
+                             '--changed-since, according to this impact map file (see --record-impact-map).')
+    parser.add_argument('--changed-since', type=str, required=False, default=DEFAULT_CHANGED_SINCE,
+                        help='The git revision changes are compared to when using --impact-map '
+                             '(default={0}).'.format(DEFAULT_CHANGED_SINCE))
+    parser.add_argument('--narrow-impact', action='store_true',
+                        help='When using --impact-map, leave the changed files no test module imports to the '
+                             'safety modules rather than running all the test modules.')
+    parser.add_argument('--from-report', type=str, required=False,
+                        help='Only run the tests which failed in the junit reports found in this directory '
+                             '(e.g. the work directory of a previous run).')
+    parser.add_argument('--record-impact-map', type=str, required=False, metavar='IMPACT_MAP',
+                        help='Write the files each test module depends on to an impact map file and exit.')
     parser.add_argument('--config-file', type=str, required=True,
                         help='Config file path (config.json).')
+    parser.add_argument('--no-refine', action='store_true',
+                        help='If specified, groups are split using longest-processing-time-first only '
+                             '(without the local search refinement pass).')
+    parser.add_argument('--no-split-modules', action='store_true',
+                        help='If specified, modules heavier than an even share of the total weight are not '
+                             'split to their tests.')
+    parser.add_argument('--slots', type=int, required=False, default=1,
+                        help='The number of test modules to run at a time on each server (default=1, '
+                             'unsafe until the tests framework uses the slot docker networks).')
+    parser.add_argument('--single-session', action='store_true',
+                        help='Run the group test modules in a single pytest session (a junit report is '
+                             'still written per module).')
+    parser.add_argument('--failures-first', action='store_true',
+                        help='Run the test modules most likely to fail (per second of running time, according '
+                             'to the durations history) first.')
+    parser.add_argument('--max-failures', type=int, required=False,
+                        help='Stop running tests once this number of test modules failed (on all servers '
+                             'when pulling test modules from a queue, or with --failures-url).')
+    parser.add_argument('--failures-url', type=str, required=False,
+                        help='Count the failed test modules of all the servers on a queue server (e.g. '
+                             'http://10.0.0.10:8000) when running a precalculated group, so --max-failures '
+                             'stops all of them.')
+    parser.add_argument('--time-budget', type=int, required=False,
+                        help='Only run the most valuable test modules (by failure rate per second, along with '
+                             'the safety modules) which fit within this number of seconds.')
+    parser.add_argument('--manager-snapshot', action='store_true',
+                        help='Snapshot a bootstrapped manager container once, and restore it before each test '
+                             'module. Experimental: the tests do not use the restored manager yet.')
+    parser.add_argument('--calibrate', action='store_true',
+                        help='Run a short benchmark (CPU, disk and docker startup) and record the speed factor '
+                             'of the server to {0}.'.format(CALIBRATION_FILE.format('<group_number>')))
+    parser.add_argument('--calibration-url', type=str, required=False,
+                        help='Share the speed factor with the other servers through a queue server (e.g. '
+                             'http://10.0.0.10:8000), and scale the weights of each group by its server speed.')
+    parser.add_argument('--speed-factors', type=str, required=False,
+                        help='A JSON file of speed factors recorded by calibrated servers, used to simulate a '
+                             'mixed pool of servers.')
+    parser.add_argument('--stable-assignment', action='store_true',
+                        help='Keep most test modules on the same server from run to run (using consistent '
+                             'hashing), as long as the groups weight stays within --stable-tolerance.')
+    parser.add_argument('--stable-tolerance', type=float, required=False, default=STABLE_ASSIGNMENT_TOLERANCE,
+                        help='How much heavier than in the regular split a server may get with '
+                             '--stable-assignment (default={0}).'.format(STABLE_ASSIGNMENT_TOLERANCE))
+    parser.add_argument('--no-predict-weights', action='store_true',
+                        help='Use the default weight for test modules with no weight, rather than predicting it '
+                             'from the weights of similar modules.')
+    parser.add_argument('--hang-timeout-factor', type=float, required=False, default=HANG_TIMEOUT_FACTOR,
+                        help='Kill test modules running over this factor times their 95th percentile duration '
+                             '(0 disables it, default={0}).'.format(HANG_TIMEOUT_FACTOR))
+    parser.add_argument('--min-hang-timeout', type=int, required=False, default=MIN_HANG_TIMEOUT,
+                        help='The minimal number of seconds to let a test module run before killing it '
+                             '(default={0}).'.format(MIN_HANG_TIMEOUT))
+    parser.add_argument('--events-file', type=str, required=False,
+                        help='Append events of the progress of the run (modules scheduled/started/finished), '
+                             'as JSON lines, to this file.')
+    parser.add_argument('--queue-file', type=str, required=False,
+                        help='Pull test modules from a shared file based queue instead of running a '
+                             'precalculated group (for running several groups on the same host).')
+    parser.add_argument('--queue-run-id', type=str, required=False,
+                        help='The id of the run (the same for all the groups pulling from the file based '
+                             'queue), so a queue file left by a previous run is not reused.')
+    parser.add_argument('--queue-url', type=str, required=False,
+                        help='Pull test modules from a queue server (e.g. http://10.0.0.10:8000) '
+                             'instead of running a precalculated group.')
+    parser.add_argument('--serve-queue', type=int, required=False, metavar='PORT',
+                        help='Serve test modules to pull from on the given port (see --queue-url).')
 
     args = parser.parse_args()
     validate_args(args)
 
     config = get_config(args.config_file)
 
-    if args.simulate:
-        simulate(args.repos, args.pattern, args.weights_file, config)
+    if args.record_impact_map:
+        record_impact_map(get_test_modules(config, args.pattern, args.repos, args.discovery_cache_file),
+                          args.repos, config, args.record_impact_map)
+    elif args.simulate:
+        simulate(args.repos, args.pattern, args.weights_file, args.weights_statistic, config, not args.no_refine,
+                 not args.no_split_modules, args.slots, args.max_servers, args.trials, args.target_time,
+                 args.discovery_cache_file, args.impact_map, args.changed_since, args.from_report,
+                 not args.no_predict_weights, args.speed_factors,
+                 args.stable_tolerance if args.stable_assignment else None, args.narrow_impact)
+    elif args.serve_queue:
+        serve_queue(args.repos, args.pattern, args.weights_file, args.weights_statistic, config, args.serve_queue,
+                    args.discovery_cache_file, args.impact_map, args.changed_since, args.failures_first,
+                    args.from_report, not args.no_predict_weights, args.narrow_impact)
     else:
-        exit_code = run_tests(args.repos, args.group_number, args.number_of_groups, args.pattern, args.dry_run, args.weights_file, config)
+        exit_code = run_tests(args.repos, args.group_number, args.number_of_groups, args.pattern, args.dry_run,
+                              args.weights_file, config,
+                              weights_statistic=args.weights_statistic,
+                              refine=not args.no_refine,
+                              queue_file=args.queue_file,
+                              queue_url=args.queue_url,
+                              split_modules=not args.no_split_modules,
+                              slots=args.slots,
+                              single_session=args.single_session,
+                              discovery_cache_file=args.discovery_cache_file,
+                              impact_map_file=args.impact_map,
+                              changed_since=args.changed_since,
+                              narrow_impact=args.narrow_impact,
+                              failures_first=args.failures_first,
+                              max_failures=args.max_failures,
+                              events_file=args.events_file,
+                              from_report=args.from_report,
+                              hang_timeout_factor=args.hang_timeout_factor,
+                              min_hang_timeout=args.min_hang_timeout,
+                              predict_weights=not args.no_predict_weights,
+                              time_budget=args.time_budget,
+                              manager_snapshot=args.manager_snapshot,
+                              calibrate=args.calibrate,
+                              calibration_url=args.calibration_url,
+                              stable_tolerance=args.stable_tolerance if args.stable_assignment else None,
+                              failures_url=args.failures_url,
+                              queue_run_id=args.queue_run_id)
         sys.exit(exit_code)